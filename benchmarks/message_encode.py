@@ -0,0 +1,39 @@
+# coding: utf-8
+"""Per-message encode cost of :mod:`mongotor.message`.
+
+    $ PYTHONPATH=. python benchmarks/message_encode.py [number]
+"""
+import sys
+import timeit
+from bson.objectid import ObjectId
+from mongotor import message
+
+DOCUMENT = {'_id': ObjectId(), 'name': 'should be name', 'size': 10,
+            'tags': ['a', 'b', 'c']}
+
+CASES = [
+    ('query', lambda: message.query(0, 'mongotor_test.bench', 0, 100,
+                                    {'name': 'should be name'})),
+    ('get_more', lambda: message.get_more('mongotor_test.bench', 100, 123456789)),
+    ('insert', lambda: message.insert('mongotor_test.bench', [DOCUMENT],
+                                      True, False, {})),
+    ('insert safe', lambda: message.insert('mongotor_test.bench', [DOCUMENT],
+                                           True, True, {'w': 1})),
+    ('insert 100 safe', lambda: message.insert('mongotor_test.bench',
+                                               [DOCUMENT] * 100, True, True, {})),
+    ('update safe', lambda: message.update('mongotor_test.bench', False, False,
+                                           {'_id': DOCUMENT['_id']},
+                                           {'$set': {'size': 11}}, True, {})),
+    ('delete safe', lambda: message.delete('mongotor_test.bench',
+                                           {'_id': DOCUMENT['_id']}, True, {})),
+]
+
+
+def main(number):
+    for name, fn in CASES:
+        best = min(timeit.repeat(fn, number=number, repeat=5))
+        print('%-16s %8.2f us/msg' % (name, best / number * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,65 @@
+# coding: utf-8
+"""Checkout and release cost of :class:`mongotor.pool.ConnectionPool`.
+
+Connections are stand-ins that never touch a socket, so only the pool
+bookkeeping is measured.
+
+    $ PYTHONPATH=. python benchmarks/pool_checkout.py [connections]
+"""
+import sys
+import time
+import timeit
+from mongotor.pool import ConnectionPool
+
+
+class _Connection(object):
+    multiplexed = False
+
+    def __init__(self):
+        self.usage = 0
+        self.created_at = self.last_used = time.time()
+
+    def closed(self):
+        return False
+
+
+class _Pool(ConnectionPool):
+
+    def _create_connection(self):
+        return _Connection()
+
+    def _deliver(self, conn, callback):
+        callback(conn)
+
+
+def _checkout_all(pool, size):
+    connections = []
+    for i in range(size):
+        pool.connection(connections.append)
+    for conn in connections:
+        pool.release(conn)
+
+
+def _checkout_one(pool, number):
+    connections = []
+    for i in range(number):
+        pool.connection(connections.append)
+        pool.release(connections.pop())
+
+
+def main(size):
+    pool = _Pool('localhost', 27017, 'test', maxconnections=size)
+
+    number = 100
+    best = min(timeit.repeat(lambda: _checkout_all(pool, size), number=number, repeat=5))
+    print('%-28s %8.2f us/op' % ('all %d out and back' % size,
+                                 best / (number * size) * 1e6))
+
+    number = 100000
+    best = min(timeit.repeat(lambda: _checkout_one(pool, number), number=1, repeat=5))
+    print('%-28s %8.2f us/op' % ('one out and back, %d idle' % size,
+                                 best / number * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,148 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to a node that keeps failing
+
+    The breaker starts `CLOSED` and remembers whether each of the last
+    `window` requests succeeded. When at least `min_requests` of them are
+    known and `failure_ratio` of them failed, because the connection
+    couldn't be established, timed out or was lost, it goes `OPEN` and
+    the node is left out of node selection.
+
+    After `reset_timeout` seconds it goes `HALF_OPEN` and lets a single
+    probe request through. The breaker closes if it succeeds and opens
+    again if it fails; outcomes of requests sent before the probe are
+    ignored. A probe that doesn't report back within `reset_timeout`
+    seconds is replaced by another one.
+
+    >>> Database.init(['localhost:27017', 'localhost:27018'], 'test',
+    ...               circuit_breaker={'failure_ratio': 0.5, 'reset_timeout': 5})
+    """
+
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(self, failure_ratio=0.5, min_requests=5, window=20, reset_timeout=5,
+                 name=None):
+        assert 0 < failure_ratio <= 1
+        assert 0 < min_requests <= window
+
+        self.failure_ratio = failure_ratio
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.name = name
+
+        self._outcomes = deque(maxlen=window)
+        self._failures = 0
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._probe_time = None
+
+    @property
+    def state(self):
+        if self._state == self.OPEN and \
+                time.time() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probe_time = None
+
+        return self._state
+
+    def allows_requests(self):
+        """Whether a request may be sent now, without taking the probe"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+
+        if state == self.OPEN:
+            return False
+
+        return self._probe_time is None or \
+            time.time() - self._probe_time >= self.reset_timeout
+
+    def allow(self):
+        """Whether a request may be sent now. In `HALF_OPEN` state this
+        takes the probe, so only the first caller is allowed."""
+        if not self.allows_requests():
+            return False
+
+        if self._state == self.HALF_OPEN:
+            self._probe_time = time.time()
+
+        return True
+
+    def record_success(self, sent_at=None):
+        """Record a request that succeeded, `sent_at` is when it was sent"""
+        if self.state == self.HALF_OPEN:
+            if self._is_probe(sent_at):
+                logger.info('{0} circuit closed'.format(self.name))
+                self._reset(self.CLOSED)
+            return
+
+        self._record(False)
+
+    def record_failure(self, sent_at=None):
+        """Record a request that failed, `sent_at` is when it was sent"""
+        state = self.state
+        if state == self.OPEN:
+            return  # requests sent before it opened
+
+        if state == self.HALF_OPEN:
+            if self._is_probe(sent_at):
+                self._open()
+            return
+
+        self._record(True)
+
+        if len(self._outcomes) >= self.min_requests and \
+                self._failures >= self.failure_ratio * len(self._outcomes):
+            self._open()
+
+    def _is_probe(self, sent_at):
+        """Whether an outcome may be the probe's, a request sent once the
+        probe was taken. Without `sent_at` any request may be."""
+        if self._probe_time is None:
+            return False
+
+        return sent_at is None or sent_at >= self._probe_time
+
+    def _record(self, failed):
+        if len(self._outcomes) == self._outcomes.maxlen and self._outcomes[0]:
+            self._failures -= 1
+
+        self._outcomes.append(failed)
+        if failed:
+            self._failures += 1
+
+    def _open(self):
+        logger.warning('{0} circuit open for {1} seconds'
+                       .format(self.name, self.reset_timeout))
+        self._reset(self.OPEN)
+        self._opened_at = time.time()
+
+    def _reset(self, state):
+        self._state = state
+        self._outcomes.clear()
+        self._failures = 0
+        self._probe_time = None
@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import logging
+import time
 from bson.code import Code
 import six
 from tornado import gen
@@ -23,19 +24,61 @@ from mongotor.node import ReadPreference
 from mongotor.cursor import Cursor
 from mongotor import message
 from mongotor import helpers
+from mongotor.errors import Error, DatabaseError, InterfaceError, NotMasterError
 
 log = logging.getLogger(__name__)
 
 
 class Client(object):
-
-    def __init__(self, database, collection):
+    """A mongo collection
+
+    :Parameters:
+      - `database`: the :class:`~mongotor.database.Database`
+      - `collection`: the collection name
+      - `write_concern` (optional): getLastError options (``w``,
+        ``wtimeout``, ``j``, ``fsync``) for writes in this collection,
+        overriding the database write concern
+      - `tag_sets` (optional): tag sets for reads in this collection that
+        may go to a secondary, overriding the database ones
+      - `max_staleness_seconds` (optional): maximum estimated lag of the
+        secondaries reads in this collection may go to, overriding the
+        database one
+      - `retry_policy` (optional): a :class:`~mongotor.retry.RetryPolicy`
+        to send reads and writes again after transient errors
+    """
+
+    def __init__(self, database, collection, write_concern=None,
+                 tag_sets=None, max_staleness_seconds=None, retry_policy=None):
         self._database = database
         self._collection = collection
         self._collection_name = database.get_collection_name(collection)
+        self._write_concern = helpers._validate_write_concern(write_concern)
+        self._tag_sets = helpers._validate_tag_sets(tag_sets)
+        self._max_staleness_seconds = max_staleness_seconds
+        self._retry_policy = retry_policy
+
+    def _get_write_concern(self, safe, write_concern=None):
+        """Resolve the write concern of an operation.
+
+        The most specific write concern wins: the one given to the call,
+        then the collection one, then the database one. Returns a
+        ``(safe, last_error_args)`` pair, ``w=0`` meaning unacknowledged.
+        """
+        if write_concern is None:
+            write_concern = self._write_concern
+        if write_concern is None:
+            write_concern = self._database._write_concern
+
+        write_concern = helpers._validate_write_concern(write_concern) or {}
+
+        if write_concern.get('w') == 0:
+            return False, {}
+
+        return safe, write_concern
 
     @gen.engine
-    def insert(self, doc_or_docs, safe=True, check_keys=True, callback=None):
+    def insert(self, doc_or_docs, safe=True, check_keys=True, coalesce=None,
+               write_concern=None, idempotent=False, callback=None):
         """Insert a document
 
         :Parameters:
@@ -45,57 +88,195 @@ class Client(object):
           - `check_keys` (optional): check if keys start with '$' or
             contain '.', raising :class:`~pymongo.errors.InvalidName`
             in either case
+          - `coalesce` (optional): send a single document together with
+            other inserts made at the same time, sharing their
+            getLastError. Defaults to the database `coalesce_inserts`.
+            When the server reports an error for a message carrying
+            several documents, it isn't raised but returned to each of
+            their callers, as the document may have been stored anyway
+          - `write_concern` (optional): getLastError options for this insert
+          - `idempotent` (optional): the insert may be retried after a
+            lost connection, e.g. documents with an ``_id`` whose
+            duplicate key error is expected
           - `callback` : method which will be called when save is finished
         """
+        safe, last_error_args = self._get_write_concern(safe, write_concern)
+
+        if coalesce is None:
+            coalesce = self._database._coalesce_inserts
+
+        if coalesce and isinstance(doc_or_docs, dict):
+            coalescer = self._database._get_coalescer(self._collection_name,
+                                                      check_keys, safe,
+                                                      last_error_args)
+            response, error, shared = yield gen.Task(coalescer.insert, doc_or_docs)
+            # an error shared by several documents may not be about this one
+            if isinstance(error, Error) and not shared:
+                raise error
+
+            if callback:
+                callback((response, error))
+            return
+
         if isinstance(doc_or_docs, dict):
             doc_or_docs = [doc_or_docs]
 
         assert isinstance(doc_or_docs, list)
 
         message_insert = message.insert(self._collection_name, doc_or_docs,
-                                        check_keys, safe, {})
+                                        check_keys, safe, last_error_args)
 
         log.debug("mongo: db.{0}.insert({1})".format(self._collection_name, doc_or_docs))
 
+        response, error = yield gen.Task(self._send_write, message_insert,
+                                         safe, idempotent)
+
+        if callback:
+            callback((response, error))
+
+    @gen.engine
+    def _send_write(self, message_write, safe, idempotent, callback):
+        """Send a write to the primary, retrying it as the retry policy
+        allows"""
+        policy = self._retry_policy
+        started = time.time()
+        attempt = 0
+
+        while True:
+            try:
+                node = yield gen.Task(self._database.get_node, ReadPreference.PRIMARY)
+                connection = yield gen.Task(node.connection)
+
+                response, error = yield gen.Task(connection.send_message,
+                                                 message_write, safe)
+                raised = False
+            except (InterfaceError, NotMasterError) as e:
+                response, error, raised = None, e, True
+
+            if error and policy and policy.should_retry(error, attempt, started, idempotent):
+                attempt += 1
+                log.debug("mongo: db.{0} retrying write after {1!r}".format(
+                    self._collection_name, error))
+                yield gen.Task(policy.wait, attempt, started)
+                continue
+
+            if raised:
+                raise error
+
+            callback((response, error))
+            return
+
+    @gen.engine
+    def insert_many(self, docs, ordered=True, safe=True, check_keys=True,
+                    concurrency=1, write_concern=None, callback=None):
+        """Insert an iterable of documents, split into as few messages as
+        the server size limits allow
+
+        Returns a ``(result, error)`` pair, where `result` aggregates the
+        batches sent::
+
+            {'inserted_count': ..., 'batch_count': ...,
+             'responses': [...], 'errors': [...]}
+
+        and `error` is the first error found, if any. `inserted_count`
+        only counts batches acknowledged without error.
+
+        :Parameters:
+          - `docs`: an iterable of documents, generators are consumed
+            lazily
+          - `ordered` (optional): if ``True`` batches are sent in order
+            and the insert stops at the first error, otherwise the server
+            keeps inserting the remaining documents after an error
+          - `safe` (optional): check that each batch succeeded?
+          - `check_keys` (optional): check if keys start with '$' or
+            contain '.', raising :class:`~pymongo.errors.InvalidName`
+            in either case
+          - `concurrency` (optional): for unordered inserts, number of
+            batches sent at once, each on its own pooled connection
+          - `write_concern` (optional): getLastError options for each batch
+          - `callback` : method which will be called when all batches are sent
+        """
+        safe, last_error_args = self._get_write_concern(safe, write_concern)
+
         node = yield gen.Task(self._database.get_node, ReadPreference.PRIMARY)
-        connection = yield gen.Task(node.connection)
 
-        response, error = yield gen.Task(connection.send_message,
-                                         message_insert, safe)
+        batches = message.insert_batches(self._collection_name, docs,
+                                         check_keys, safe, last_error_args, not ordered,
+                                         node.max_bson_size, node.max_message_size)
+
+        result = {'inserted_count': 0, 'batch_count': 0,
+                  'responses': [], 'errors': []}
+
+        if ordered or concurrency <= 1:
+            yield gen.Task(self._send_batches, node, batches, safe,
+                           ordered, result)
+        else:
+            # the batches generator is shared, each sender pulls the next
+            # batch as soon as its previous one is acknowledged
+            yield [gen.Task(self._send_batches, node, batches, safe, False, result)
+                   for i in range(concurrency)]
 
         if callback:
-            callback((response, error))
+            callback((result, result['errors'][0] if result['errors'] else None))
+
+    @gen.engine
+    def _send_batches(self, node, batches, safe, ordered, result, callback):
+        for message_insert, count in batches:
+            log.debug("mongo: db.{0}.insert_many(<{1} documents>)".format(
+                self._collection_name, count))
+
+            result['batch_count'] += 1
+            connection = yield gen.Task(node.connection)
+            try:
+                response, error = yield gen.Task(connection.send_message,
+                                                 message_insert, safe)
+            except DatabaseError as de:
+                response, error = None, de
+
+            if error:
+                result['errors'].append(error)
+                if ordered:
+                    break
+                continue
+
+            result['inserted_count'] += count
+            if response:
+                result['responses'].append(response)
+
+        callback()
 
     @gen.engine
-    def remove(self, spec_or_id={}, safe=True, callback=None):
+    def remove(self, spec_or_id={}, safe=True, write_concern=None, callback=None):
         """remove a document
 
         :Parameters:
         - `spec_or_id`: a query or a document id
         - `safe` (optional): safe insert operation
+        - `write_concern` (optional): getLastError options for this remove
         - `callback` : method which will be called when save is finished
         """
+        safe, last_error_args = self._get_write_concern(safe, write_concern)
+
         if not isinstance(spec_or_id, dict):
             spec_or_id = {"_id": spec_or_id}
 
         assert isinstance(spec_or_id, dict)
 
         message_delete = message.delete(self._collection_name, spec_or_id,
-                                        safe, {})
+                                        safe, last_error_args)
 
         log.debug("mongo: db.{0}.remove({1})".format(self._collection_name, spec_or_id))
-        node = yield gen.Task(self._database.get_node, ReadPreference.PRIMARY)
-        connection = yield gen.Task(node.connection)
 
-        response, error = yield gen.Task(connection.send_message,
-                                         message_delete, safe)
+        # removing the same documents twice is harmless
+        response, error = yield gen.Task(self._send_write, message_delete,
+                                         safe, True)
 
         if callback:
             callback((response, error))
 
     @gen.engine
     def update(self, spec, document, upsert=False, safe=True,
-               multi=False, callback=None):
+               multi=False, write_concern=None, idempotent=False, callback=None):
         """Update a document(s) in this collection.
 
         :Parameters:
@@ -114,23 +295,25 @@ class Client(object):
             might eventually change to ``True``. It is recommended
             that you specify this argument explicitly for all update
             operations in order to prepare your code for that change.
+          - `write_concern` (optional): getLastError options for this update
+          - `idempotent` (optional): the update may be retried after a
+            lost connection, e.g. a ``$set`` without ``$inc`` or ``$push``
         """
         assert isinstance(spec, dict), "spec must be an instance of dict"
         assert isinstance(document, dict), "document must be an instance of dict"
         assert isinstance(upsert, bool), "upsert must be an instance of bool"
         assert isinstance(safe, bool), "safe must be an instance of bool"
 
+        safe, last_error_args = self._get_write_concern(safe, write_concern)
+
         message_update = message.update(self._collection_name, upsert,
-                                        multi, spec, document, safe, {})
+                                        multi, spec, document, safe, last_error_args)
 
         log.debug("mongo: db.{0}.update({1}, {2}, {3}, {4})".format(
             self._collection_name, spec, document, upsert, multi))
 
-        node = yield gen.Task(self._database.get_node, ReadPreference.PRIMARY)
-        connection = yield gen.Task(node.connection)
-
-        response, error = yield gen.Task(connection.send_message,
-                                         message_update, safe)
+        response, error = yield gen.Task(self._send_write, message_update,
+                                         safe, idempotent)
 
         callback((response, error))
 
@@ -200,7 +383,38 @@ class Client(object):
             examined when performing the query
           - `read_preferences` (optional): The read preference for
             this query.
+          - `batch_size` (optional): the number of documents to fetch
+            per batch. The cursor pages through the rest of the result
+            set with getMore
+          - `prefetch` (optional): number of batches to request ahead
+            while the current one is consumed. Depths above one need a
+            multiplexed connection pool
+          - `document_class` (optional): class to use for the documents
+            returned, default is :class:`dict`
+          - `raw` (optional): return
+            :class:`~bson.raw_bson.RawBSONDocument` documents, decoded
+            only when a field is accessed. Useful to forward documents
+            as they are
+          - `tag_sets` (optional): tag sets the node a secondary read
+            goes to must match, overriding the collection ones
+          - `max_staleness_seconds` (optional): maximum estimated lag of
+            the secondary a read goes to, overriding the collection one
+          - `retry_policy` (optional): a :class:`~mongotor.retry.RetryPolicy`
+            for the query, overriding the collection one. Only the query is
+            retried, not the getMores that follow
+          - `hedge` (optional): for latency critical `find_one` and small
+            `find` calls that may go to a secondary, send the query to a
+            second node as well when the first one hasn't replied after
+            `hedge_delay`. The first reply wins
+          - `hedge_delay` (optional): seconds to wait before hedging.
+            default is three times the round trip time of the first node
         """
+        if kwargs.get('tag_sets') is None:
+            kwargs['tag_sets'] = self._tag_sets
+        if kwargs.get('max_staleness_seconds') is None:
+            kwargs['max_staleness_seconds'] = self._max_staleness_seconds
+        if kwargs.get('retry_policy') is None:
+            kwargs['retry_policy'] = self._retry_policy
 
         log.debug("mongo: db.{0}.find({spec}).limit({limit}).sort({sort})".format(
             self._collection_name,
@@ -0,0 +1,131 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+from functools import partial
+from datetime import timedelta
+import bson
+from tornado import gen
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+from mongotor.node import ReadPreference
+from mongotor.errors import DatabaseError, InvalidOperationError, \
+    NotMasterError, TimeoutError
+from mongotor import message
+
+logger = logging.getLogger(__name__)
+
+
+class InsertCoalescer(object):
+    """Collects single document inserts into one collection and sends
+    them together as multi-document insert messages
+
+    Inserts made in the same ioloop iteration, or within `window`
+    microseconds of the first one, share a message and a getLastError.
+    Documents are sent with continueOnError, so a failing document
+    doesn't stop the others.
+
+    Each caller receives the ``(response, error, shared)`` of the message
+    its document went in. The server doesn't tell which document an
+    error like a duplicate key is about, so when the message carries
+    several documents `shared` is ``True``: the caller's document may
+    have been stored anyway.
+    """
+
+    def __init__(self, database, collection_name, check_keys=True, safe=True,
+                 last_error_args=None, window=0):
+        self._database = database
+        self._collection_name = collection_name
+        self._check_keys = check_keys
+        self._safe = safe
+        self._last_error_args = last_error_args or {}
+        self._window = window
+        self._pending = []
+        self._scheduled = False
+
+    def insert(self, document, callback):
+        # encode now, so an invalid document fails for its caller only
+        encoded = bson.BSON.encode(document, self._check_keys)
+
+        self._pending.append((encoded, stack_context.wrap(callback)))
+
+        if not self._scheduled:
+            self._scheduled = True
+            with stack_context.NullContext():
+                if self._window:
+                    IOLoop.instance().add_timeout(
+                        timedelta(microseconds=self._window), self._flush)
+                else:
+                    IOLoop.instance().add_callback(self._flush)
+
+    @gen.engine
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        self._scheduled = False
+
+        try:
+            node = yield gen.Task(self._database.get_node, ReadPreference.PRIMARY)
+
+            # a document too large fails for its caller only
+            too_large = [caller for caller in pending if len(caller[0]) > node.max_bson_size]
+            if too_large:
+                pending = [caller for caller in pending
+                           if len(caller[0]) <= node.max_bson_size]
+            for caller in too_large:
+                self._resolve([caller], None, InvalidOperationError(
+                    "document too large (%d bytes), the maximum size is %d bytes" %
+                    (len(caller[0]), node.max_bson_size)))
+            if not pending:
+                return
+
+            batches = message.insert_batches(self._collection_name,
+                                             [encoded for encoded, _ in pending],
+                                             self._check_keys, self._safe,
+                                             self._last_error_args, True,
+                                             node.max_bson_size, node.max_message_size)
+
+            for message_insert, count in batches:
+                callers = pending[:count]
+
+                logger.debug("mongo: db.{0}.insert(<{1} coalesced documents>)".format(
+                    self._collection_name, count))
+
+                connection = yield gen.Task(node.connection)
+                try:
+                    response, error = yield gen.Task(connection.send_message,
+                                                     message_insert, self._safe)
+                except DatabaseError as de:
+                    response, error = None, de
+
+                pending = pending[count:]
+                self._resolve(callers, response, error,
+                              shared=count > 1 and self._ambiguous(error))
+        except Exception as error:
+            logger.error("mongo: db.{0} coalesced insert failed: {1!r}".format(
+                self._collection_name, error))
+            self._resolve(pending, None, error)
+
+    def _ambiguous(self, error):
+        """Whether `error` may concern only some documents of a message.
+        A node that is not the primary rejects them all, and a write
+        concern timeout applies to all of them."""
+        return isinstance(error, DatabaseError) and \
+            not isinstance(error, (NotMasterError, TimeoutError))
+
+    def _resolve(self, callers, response, error, shared=False):
+        for _, callback in callers:
+            if callback:
+                IOLoop.instance().add_callback(partial(callback, (response, error, shared)))
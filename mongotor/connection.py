@@ -16,28 +16,53 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import with_statement
 from tornado import iostream
+from tornado.iostream import StreamClosedError
 from tornado import stack_context
+from tornado.ioloop import IOLoop
 from mongotor.errors import InterfaceError, IntegrityError, \
-    ProgrammingError, DatabaseError
+    ProgrammingError, DatabaseError, TimeoutError, NotMasterError
 from mongotor import helpers
+from mongotor import events
 import socket
 import logging
 import struct
+import time
 import contextlib
+from datetime import timedelta
+from functools import partial
 
 logger = logging.getLogger(__name__)
 
 
 class Connection(object):
+    """A socket connected to a mongo node.
 
-    def __init__(self, host, port, pool=None, autoreconnect=True, timeout=5):
+    By default a connection carries a single operation at a time and goes
+    back to its pool as soon as the reply arrives. When `multiplex` is
+    enabled many requests may be outstanding at once, and each reply is
+    routed back to its caller through the ``responseTo`` field of the
+    reply header.
+
+    The connection is established asynchronously; messages sent before it
+    is ready are buffered, and :meth:`ready` tells when it is usable. An
+    attempt taking longer than `timeout` seconds is aborted.
+    """
+
+    def __init__(self, host, port, pool=None, autoreconnect=True, timeout=5,
+                 multiplex=False):
         self._host = host
         self._port = port
         self._pool = pool
         self._autoreconnect = autoreconnect
         self._timeout = timeout
+        self._multiplex = multiplex
         self._connected = False
-        self._callback = None
+        self._connecting = False
+        self._connect_callbacks = []
+        self._connect_timeout = None
+        self._connect_error = None
+        self._requests = {}
+        self._reading = False
 
         self._connect()
 
@@ -45,44 +70,135 @@ class Connection(object):
 
     def _connect(self):
         self.usage = 0
+        self.created_at = self.last_used = self.last_sent = time.time()
+        self._requests = {}
+        self._reading = False
+        self._connect_error = None
         try:
-            socket.timeout(self._timeout)
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-            s.connect((self._host, self._port))
+            family = socket.AF_INET6 if ":" in self._host else socket.AF_INET
+            s = socket.socket(family, socket.SOCK_STREAM, 0)
 
             self._stream = iostream.IOStream(s)
             self._stream.set_close_callback(self._socket_close)
 
             self._connected = True
+            self._connecting = True
+            self._connect_timeout = IOLoop.instance().add_timeout(
+                timedelta(seconds=self._timeout), self._on_connect_timeout)
+
+            with stack_context.NullContext():
+                self._stream.connect((self._host, self._port),
+                                     callback=self._on_connect)
         except socket.error as error:
             raise InterfaceError(error)
 
+    def _on_connect(self):
+        logger.debug('{0} connected'.format(self))
+        self._connecting = False
+        self._cancel_connect_timeout()
+
+        if self._requests and not self._reading:
+            self._read_header()
+
+        self._run_connect_callbacks(None)
+
+    def _on_connect_timeout(self):
+        self._connect_timeout = None
+        if self._connecting:
+            logger.error('{0} timed out connecting to {1}:{2}'
+                         .format(self, self._host, self._port))
+            self._connect_error = InterfaceError('connect timed out')
+            self._stream.close()
+
+    def _cancel_connect_timeout(self):
+        if self._connect_timeout:
+            IOLoop.instance().remove_timeout(self._connect_timeout)
+            self._connect_timeout = None
+
+    def _run_connect_callbacks(self, error):
+        callbacks, self._connect_callbacks = self._connect_callbacks, []
+        for callback in callbacks:
+            callback(error)
+
+    def ready(self, callback):
+        """Call `callback` once the connection is established.
+
+        `callback` receives ``None`` when the connection is usable or the
+        :class:`~mongotor.errors.InterfaceError` that prevented it.
+        """
+        if self.closed():
+            if not self._autoreconnect:
+                callback(InterfaceError('connection is closed and autoreconnect is false'))
+                return
+            self._connect()
+
+        if not self._connecting:
+            callback(None)
+            return
+
+        self._connect_callbacks.append(stack_context.wrap(callback))
+
     def __repr__(self):
         return "Connection {0} ::: ".format(id(self))
 
+    @property
+    def multiplexed(self):
+        return self._multiplex
+
+    @property
+    def in_flight(self):
+        """Number of requests waiting for a reply on this connection"""
+        return len(self._requests)
+
     def _parse_header(self, header):
         #logger.debug('got data %r' % header)
         length = int(struct.unpack("<i", header[:4])[0])
-        _request_id = struct.unpack("<i", header[8:12])[0]
-
-        assert _request_id == self._request_id, \
-            "ids don't match %r %r" % (self._request_id, _request_id)
+        response_to = struct.unpack("<i", header[8:12])[0]
 
         operation = 1  # who knows why
         assert operation == struct.unpack("<i", header[12:])[0]
         #logger.debug('%s' % length)
         #logger.debug('waiting for another %d bytes' % (length - 16))
 
-        self._stream.read_bytes(length - 16, callback=self._parse_response)
+        self._stream.read_bytes(length - 16,
+                                callback=partial(self._parse_response, response_to))
+
+    def _parse_response(self, response_to, response):
+        request = self._requests.pop(response_to, None)
+
+        if self._requests:
+            self._read_header()
+        else:
+            self._reading = False
+
+        if request is None:
+            logger.warn('{0} discarding reply to unknown request {1}'
+                        .format(self, response_to))
+            return
 
-    def _parse_response(self, response):
-        callback = self._callback
-        check_response = self._check_response
-        self.reset()
         self.release()
 
+        _, on_reply, _ = request
+        on_reply(response)
+
+    def _on_reply(self, callback, check_response, command, sent_at, response):
+        if self._pool:
+            self._pool.reply_received(self, sent_at)
+
+        if command:
+            reply_size = 16 + len(response)
+            document_count = helpers._reply_number_returned(response)
+
         if check_response:
-            response = self.__check_response_to_last_error(response)
+            try:
+                response = self.__check_response_to_last_error(response)
+            except Exception as error:
+                if command:
+                    command.failed(error)
+                raise
+
+        if command:
+            command.succeeded(reply_size, document_count)
 
         #logger.debug('response: %s' % response)
         callback((response, None))
@@ -105,6 +221,12 @@ class Connection(object):
         if error_msg is None:
             return error
 
+        if error.get("wtimeout"):
+            raise TimeoutError(error_msg, error.get("code"))
+
+        if helpers._is_not_master(error_msg, error.get("code")):
+            raise NotMasterError(error_msg, error.get("code"))
+
         details = error
         # mongos returns the error code in an error object
         # for some errors.
@@ -122,48 +244,117 @@ class Connection(object):
         else:
             raise DatabaseError(details["err"])
 
+    def _pop_requests(self):
+        requests = list(self._requests.values())
+        self.reset()
+        return requests
+
+    def _fail_requests(self, requests, error):
+        for callback, _, command in requests:
+            if command:
+                command.failed(error)
+            if callback:
+                callback((None, error))
+
     def _socket_close(self):
         logger.debug('{0} connection stream closed'.format(self))
-        if self._callback:
-            self._callback((None, InterfaceError('connection closed')))
-
-        self.reset()
+        requests = self._pop_requests()
+        lost = self._connected  # not closed by us
         self._connected = False
+        self._cancel_connect_timeout()
+
+        connect_error = None
+        if self._connecting:
+            self._connecting = False
+            connect_error = self._connect_error or \
+                InterfaceError(self._stream.error or 'connection closed')
+
         self.release()
+        if lost and self._pool:
+            self._pool.connection_lost(self)
+
+        self._fail_requests(requests, connect_error or InterfaceError('connection closed'))
+        if connect_error:
+            self._run_connect_callbacks(connect_error)
 
     def close(self):
         logger.debug('{0} connection close'.format(self))
-        if self._callback:
-            self._callback((None, InterfaceError('connection closed')))
-
-        self.reset()
+        requests = self._pop_requests()
         self._connected = False
         self._stream.close()
 
+        self._fail_requests(requests, InterfaceError('connection closed'))
+
     def closed(self):
         return not self._connected
 
     def release(self):
+        self.last_used = time.time()
         if self._pool:
             self._pool.release(self)
 
     def reset(self):
-        self._callback = None
-        self._request_id = None
-        self._check_response = False
+        self._requests = {}
+        self._reading = False
 
     @contextlib.contextmanager
-    def close_on_error(self):
+    def close_on_error(self, request_id=None):
         try:
             yield
+        except NotMasterError as nme:
+            logger.error('{0} node is not the primary: {1}'.format(self, nme))
+            if self._pool:
+                self._pool.not_master(self)
+            raise
         except DatabaseError as de:
             logger.error('database error'.format(de))
             raise
+        except (StreamClosedError, socket.error):
+            logger.error('{0} stream error in operation'.format(self))
+            self.close()
+            raise
         except Exception:
             logger.error('{0} exception in operation'.format(self))
-            self.close()
+            if not self._multiplex:
+                self.close()
+                raise
+
+            # other requests share the socket, only this one is given up
+            if self._requests.pop(request_id, None) is not None:
+                self.release()
             raise
 
+    def _prepare_to_send(self):
+        if self._requests and not self._multiplex:
+            raise ProgrammingError('connection already in use')
+
+        if self.closed():
+            if self._autoreconnect:
+                self._connect()
+            else:
+                raise InterfaceError('connection is closed and autoreconnect is false')
+
+    def _expect_reply(self, request_id, callback, check_response, command):
+        """Register a request whose reply must be routed to `callback`.
+
+        The reply is delivered inside the stack context active at
+        registration, so errors found while checking it reach the caller
+        that sent the request and not whoever happens to be reading.
+        """
+        self.last_sent = time.time()
+        on_reply = stack_context.wrap(partial(self._on_reply, callback,
+                                              check_response, command,
+                                              self.last_sent))
+        self._requests[request_id] = (callback, on_reply, command)
+
+        if not self._reading and not self._connecting:
+            self._read_header()
+
+    def _read_header(self):
+        self._reading = True
+        with stack_context.NullContext():
+            self._stream.read_bytes(16, callback=self._parse_header)
+
     def send_message(self, message, with_last_error=False, callback=None):
         """Say something to Mongo.
 
@@ -178,37 +369,39 @@ class Connection(object):
           - `with_last_error`: check getLastError status after sending the
             message
         """
-        if self._callback is not None:
-            raise ProgrammingError('connection already in use')
+        self._prepare_to_send()
 
-        if self.closed():
-            if self._autoreconnect:
-                self._connect()
-            else:
-                raise InterfaceError('connection is closed and autoreconnect is false')
+        callback = stack_context.wrap(callback)
 
-        self._callback = stack_context.wrap(callback)
-        self._check_response = with_last_error
+        with stack_context.StackContext(partial(self.close_on_error, message[0])):
+            self.__send_message(message, callback,
+                                with_last_error=with_last_error)
 
-        with stack_context.StackContext(self.close_on_error):
-            self.__send_message(message, with_last_error=with_last_error)
-
-    def __send_message(self, message, with_last_error=False):
+    def __send_message(self, message, callback, with_last_error=False):
         self.usage += 1
 
-        (self._request_id, message) = message
-
-        self._stream.write(message)
+        command = events._start_message(message, (self._host, self._port))
+        (request_id, message) = message
 
         if with_last_error:
-            self._stream.read_bytes(16, callback=self._parse_header)
+            self._expect_reply(request_id, callback, True, command)
+            self._stream.write(message)
             return
 
-        self.reset()
+        self.last_sent = time.time()
+        try:
+            self._stream.write(message)
+        except Exception as error:
+            if command:
+                command.failed(error)
+            raise
+
+        if command:
+            command.succeeded(0, 0)
         self.release()
 
-        if self._callback:
-            self._callback()
+        if callback:
+            callback((None, None))
 
     def send_message_with_response(self, message, callback):
         """Send a message to Mongo and return the response.
@@ -218,25 +411,18 @@ class Connection(object):
         :Parameters:
           - `message`: (request_id, data) pair making up the message to send
         """
-        if self._callback is not None:
-            raise ProgrammingError('connection already in use')
-
-        if self.closed():
-            if self._autoreconnect:
-                self._connect()
-            else:
-                raise InterfaceError('connection is closed and autoreconnect is false')
+        self._prepare_to_send()
 
-        self._callback = stack_context.wrap(callback)
-        self._check_response = False
+        callback = stack_context.wrap(callback)
 
-        with stack_context.StackContext(self.close_on_error):
-            self.__send_message_and_receive(message)
+        with stack_context.StackContext(partial(self.close_on_error, message[0])):
+            self.__send_message_and_receive(message, callback)
 
-    def __send_message_and_receive(self, message):
+    def __send_message_and_receive(self, message, callback):
         self.usage += 1
 
-        (self._request_id, message) = message
+        command = events._start_message(message, (self._host, self._port))
+        (request_id, message) = message
 
+        self._expect_reply(request_id, callback, False, command)
         self._stream.write(message)
-        self._stream.read_bytes(16, callback=self._parse_header)
@@ -15,11 +15,21 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import logging
+import sys
+import time
+from collections import deque
+from datetime import timedelta
 import six
 from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
 from bson import SON
 from mongotor import message
 from mongotor import helpers
+from mongotor import events
+from mongotor.node import ReadPreference
+from mongotor.errors import (Error, DatabaseError, InvalidOperationError,
+    InterfaceError, NotMasterError)
 
 _QUERY_OPTIONS = {
     "tailable_cursor": 2,
@@ -30,6 +40,12 @@ _QUERY_OPTIONS = {
 DESCENDING = -1
 ASCENDING = 1
 
+# a hedged query goes to a second node after this many times the round
+# trip time of the first one, in seconds
+HEDGE_RTT_MULTIPLIER = 3
+MIN_HEDGE_DELAY = 0.005
+DEFAULT_HEDGE_DELAY = 0.05
+
 logger = logging.getLogger(__name__)
 
 
@@ -40,7 +56,10 @@ class Cursor(object):
     def __init__(self, database, collection, spec_or_id=None, fields=None, snapshot=False,
         tailable=False, max_scan=None, is_command=False, explain=False, hint=None,
         skip=0, limit=0, sort=None, connection=None,
-        read_preference=None, timeout=True, slave_okay=True, **kw):
+        read_preference=None, timeout=True, slave_okay=True, batch_size=0,
+        prefetch=0, document_class=dict, raw=False, tag_sets=None,
+        max_staleness_seconds=None, retry_policy=None, hedge=False,
+        hedge_delay=None, **kw):
 
         if spec_or_id is not None and not isinstance(spec_or_id, dict):
             spec_or_id = {"_id": spec_or_id}
@@ -53,7 +72,13 @@ class Cursor(object):
             if not isinstance(fields, dict):
                 fields = helpers._fields_list_to_dict(fields)
 
+        if raw:
+            if helpers.RawBSONDocument is None:
+                raise InvalidOperationError("raw documents need PyMongo 3.2 or newer")
+            document_class = helpers.RawBSONDocument
+
         self._fields = fields
+        self._document_class = document_class
         self._snapshot = snapshot
         self._tailable = tailable
         self._max_scan = max_scan
@@ -66,35 +91,413 @@ class Cursor(object):
         self._explain = explain
         self._slave_okay = slave_okay
         self._read_preference = read_preference
+        self._tag_sets = helpers._validate_tag_sets(tag_sets)
+        self._max_staleness_seconds = helpers._validate_max_staleness(
+            max_staleness_seconds, database._heartbeat_interval)
         self._connection = connection
+        self._given_connection = connection
+        self._retry_policy = retry_policy
+        self._hedge = hedge
+        self._hedge_delay = hedge_delay
         self._ordering = sort
         self._skip = skip
         self._limit = limit
+        self._batch_size = batch_size
+        self._node = None
+        self._cursor_id = None
+        self._retrieved = 0
+        self._buffer = deque()
+        self._prefetch = prefetch
+        self._pending = 0
+        self._in_flight = deque()
+        self._finding = False
+        self._find_command = None
+        self._reply_size = 0
+
+    @property
+    def alive(self):
+        """Does this cursor have documents left to return?
+
+        A tailable cursor stays alive while its server side cursor is
+        open, even if it has nothing to return right now.
+        """
+        return bool(self._buffer) or self._cursor_id != 0
+
+    def _num_to_return(self):
+        """Get the number of documents to ask for in the next batch"""
+        if self._limit < 0:
+            return self._limit
+
+        batch_size = self._batch_size
+        if batch_size == 1:
+            batch_size = 2  # 1 would close the cursor after the first batch
+
+        if self._limit:
+            remaining = self._limit - self._retrieved - self._pending
+            if batch_size:
+                return min(remaining, batch_size)
+            return remaining
+
+        return batch_size
+
+    @gen.engine
+    def _get_connection(self, callback):
+        if self._connection:
+            callback(self._connection)
+            return
+
+        # every batch of a cursor must come from the same node
+        if self._node is None:
+            self._node = yield gen.Task(self._database.get_node, self._read_preference,
+                                        self._tag_sets, self._max_staleness_seconds)
+
+        self._node.connection(callback)
+
+    @gen.coroutine
+    def _send_request(self, message_query, retryable=False):
+        policy = self._retry_policy
+        started = time.time()
+        attempt = 0
+
+        while True:
+            try:
+                connection = yield gen.Task(self._get_connection)
+
+                # pipelined getMores must reach the server in order, so a cursor
+                # sticks to its multiplexed connection
+                if connection.multiplexed and not self._connection:
+                    self._connection = connection
+
+                response, error = yield gen.Task(connection.send_message_with_response,
+                                                 message_query)
+                if error:
+                    raise error
+            except (InterfaceError, NotMasterError) as error:
+                if not (retryable and policy and policy.should_retry(error, attempt, started)):
+                    raise
+
+                attempt += 1
+                logger.debug('{0} retrying query after {1!r}'.format(
+                    self._collection_name, error))
+                yield gen.Task(policy.wait, attempt, started)
+
+                # the query may go to another node
+                self._connection = self._given_connection
+                if self._connection is None:
+                    self._node = None
+                continue
+
+            raise gen.Return(response)
+
+    def _address(self):
+        if self._node is None:
+            return None
+
+        return (self._node.host, self._node.port)
+
+    def _hedged(self):
+        if not self._hedge or self._given_connection is not None or self._node is not None:
+            return False
+
+        read_preference = self._read_preference
+        if read_preference is None:
+            read_preference = self._database._read_preference
+
+        return read_preference != ReadPreference.PRIMARY
+
+    def _hedge_delay_for(self, node):
+        if self._hedge_delay is not None:
+            return self._hedge_delay
+
+        if node.round_trip_time is None:
+            return DEFAULT_HEDGE_DELAY
+
+        return max(MIN_HEDGE_DELAY, HEDGE_RTT_MULTIPLIER * node.round_trip_time)
+
+    @gen.coroutine
+    def _send_to_node(self, node, message_query):
+        connection = yield gen.Task(node.connection)
+
+        response, error = yield gen.Task(connection.send_message_with_response,
+                                         message_query)
+        if error:
+            raise error
+
+        raise gen.Return((node, connection, response))
+
+    @gen.coroutine
+    def _send_hedged_query(self, message_query):
+        """Send the query to a node and, if it fails or hasn't replied
+        after the hedge delay, to a second eligible node too. The first
+        reply wins and the cursor goes on with the node that sent it. A
+        cursor the other node may have opened is killed. The query fails
+        only when every node asked fails.
+        """
+        node = yield gen.Task(self._database.get_node, self._read_preference,
+                              self._tag_sets, self._max_staleness_seconds)
+        requests = [self._send_to_node(node, message_query)]
+
+        yield self._reply_or_delay(requests[0], self._hedge_delay_for(node))
+
+        winner = None
+        if requests[0].done():
+            error = requests[0].exception()
+            if error is None:
+                winner = requests[0].result()
+            elif isinstance(error, Error):
+                logger.debug('{0} query to {1} failed: {2!r}'.format(
+                    self._collection_name, node, error))
+            else:
+                raise error
+
+        if winner is None:
+            try:
+                other = yield gen.Task(self._database.get_node, self._read_preference,
+                                       self._tag_sets, self._max_staleness_seconds,
+                                       exclude=[node])
+                logger.debug('{0} hedging query to {1}'.format(self._collection_name, other))
+                requests.append(self._send_to_node(other, message_query))
+            except DatabaseError:
+                pass  # no other node to ask
+
+            winner = yield self._first_reply(requests)
+
+        node, connection, response = winner
+        self._node = node
+        if connection.multiplexed:
+            self._connection = connection
+
+        raise gen.Return(response)
+
+    def _reply_or_delay(self, request, delay):
+        """Resolve once `request` is done or after `delay` seconds,
+        whichever comes first"""
+        done = Future()
+
+        def wake(*args):
+            if not done.done():
+                IOLoop.instance().remove_timeout(timeout)
+                done.set_result(None)
+
+        timeout = IOLoop.instance().add_timeout(timedelta(seconds=delay), wake)
+        request.add_done_callback(wake)
+
+        return done
+
+    def _first_reply(self, requests):
+        """Resolve with the first successful reply, failing only when
+        every request fails. Replies arriving later are discarded."""
+        result = Future()
+        pending = [len(requests)]
+
+        def on_reply(future):
+            pending[0] -= 1
+            if result.done():
+                if not future.exception():
+                    self._discard_reply(*future.result())
+                return
+
+            if not future.exception():
+                result.set_result(future.result())
+            elif not pending[0]:
+                result.set_exception(future.exception())
+
+        for request in requests:
+            request.add_done_callback(on_reply)
+
+        return result
+
+    def _discard_reply(self, node, connection, response):
+        cursor_id = helpers._reply_cursor_id(response)
+        if cursor_id:
+            node.connection(lambda connection: connection.send_message(
+                message.kill_cursors([cursor_id]), callback=None))
+
+    def _request_batch(self):
+        """Send the query, or a getMore for the next batch, queueing the
+        pending reply.
+        """
+        num_to_return = self._num_to_return()
+
+        if self._cursor_id is None:
+            message_query = message.query(self._query_options(), self._collection_name,
+                self._skip, num_to_return, self._query_spec(), self._fields)
+
+            if self._finding:
+                request_id, data = message_query
+                self._find_command = events._start('find', self._collection_name,
+                                                   request_id, self._address(), len(data))
+        else:
+            message_query = message.get_more(self._collection_name,
+                num_to_return, self._cursor_id)
+
+        if self._cursor_id is None and self._hedged():
+            future = self._send_hedged_query(message_query)
+        else:
+            # only the query can go to another node, a getMore belongs to
+            # the node that opened the cursor
+            future = self._send_request(message_query, self._cursor_id is None)
+        # replies to batches prefetched past the end are never consumed
+        future.add_done_callback(lambda f: f.exception())
+
+        self._pending += max(num_to_return, 0)
+        self._in_flight.append((future, num_to_return))
+
+    def _prefetch_batches(self):
+        """Keep up to `prefetch` getMores in flight while the current batch
+        is consumed. Without a multiplexed connection only one request can
+        be outstanding, so the depth is capped at one.
+        """
+        depth = self._prefetch
+        if not self._connection or not self._connection.multiplexed:
+            depth = min(depth, 1)
+
+        while self._cursor_id and len(self._in_flight) < depth:
+            if self._limit > 0 and self._retrieved + self._pending >= self._limit:
+                break
+
+            self._request_batch()
+
+    @gen.coroutine
+    def _unpack_response(self, response, cursor_id):
+        """Decode a reply to a request for `cursor_id`, in the database
+        decode executor when it is larger than the decode threshold, so
+        the ioloop keeps serving other requests meanwhile.
+        """
+        executor = self._database._decode_executor
+        try:
+            if executor is not None and len(response) > self._database._decode_threshold:
+                response = yield executor.submit(helpers._unpack_response, response,
+                                                 cursor_id, self._document_class)
+            else:
+                response = helpers._unpack_response(response, cursor_id,
+                                                    self._document_class)
+        except NotMasterError:
+            if self._node:
+                self._node._on_not_master()
+            raise
+
+        raise gen.Return(response)
+
+    @gen.engine
+    def _refresh(self, callback):
+        """Get the next batch of documents into the buffer"""
+        if not self._in_flight:
+            self._request_batch()
+
+        future, num_to_return = self._in_flight.popleft()
+        self._pending -= max(num_to_return, 0)
+
+        response = yield future
+        self._reply_size += 16 + len(response)
+
+        # the header is enough to ask for the next batch, so its round
+        # trip overlaps decoding this one
+        requested_cursor_id = self._cursor_id
+        self._cursor_id = helpers._reply_cursor_id(response)
+        self._retrieved += helpers._reply_number_returned(response)
+        if self._cursor_id and not (self._limit > 0 and self._retrieved >= self._limit):
+            self._prefetch_batches()
+
+        response = yield self._unpack_response(response, requested_cursor_id)
+        self._buffer.extend(response['data'])
+
+        if self._limit > 0 and self._retrieved >= self._limit:
+            self.close()
+        elif not self._cursor_id:
+            self._in_flight.clear()
+
+        callback(len(response['data']))
 
     @gen.engine
     def find(self, callback=None):
-        message_query = message.query(self._query_options(), self._collection_name,
-            self._skip, self._limit, self._query_spec(), self._fields)
+        """Run the query and return all documents found.
+
+        Batches are requested with getMore until the result set is
+        exhausted. Use :meth:`fetch_next` to stream large result sets
+        instead of holding them in memory.
+        """
+        documents = []
+        # a command is a single message, already seen by connection listeners
+        self._finding = not self._is_command
+        try:
+            while True:
+                returned = yield gen.Task(self._refresh)
+
+                documents.extend(self._buffer)
+                self._buffer.clear()
+
+                if not self._cursor_id or (self._tailable and not returned):
+                    break
+        except Exception as error:
+            self.close()
+            if self._find_command:
+                self._find_command.failed(error, self._address())
+            raise
 
-        if not self._connection:
-            node = yield gen.Task(self._database.get_node, self._read_preference)
-            connection = yield gen.Task(node.connection)
+        self.close()
+
+        if self._find_command:
+            self._find_command.succeeded(self._reply_size, len(documents), self._address())
+
+        if self._limit == -1 and len(documents) == 1:
+            callback((documents[0], None))
         else:
-            connection = self._connection
+            callback((documents, None))
 
-        response, _ = yield gen.Task(connection.send_message_with_response, message_query)
-        response = helpers._unpack_response(response)
+    @gen.coroutine
+    def fetch_next(self):
+        """Fetch the next batch of documents when the current one is
+        consumed.
 
-        # close cursor
-        if response and response.get('cursor_id'):
-            cursor_id = response['cursor_id']
+        Resolves to ``True`` when a document is available through
+        :meth:`next_object`, ``False`` when the cursor is exhausted.
 
+        >>> cursor = db.collection.find({}, batch_size=100)
+        >>> while (yield cursor.fetch_next()):
+        >>>     document = cursor.next_object()
+        """
+        if not self._buffer and self._cursor_id != 0:
+            try:
+                yield gen.Task(self._refresh)
+            except Exception:
+                self.close()
+                raise
+
+        raise gen.Return(bool(self._buffer))
+
+    def next_object(self):
+        """Get the next document fetched by :meth:`fetch_next`"""
+        if not self._buffer:
+            return None
+
+        return self._buffer.popleft()
+
+    if sys.version_info >= (3, 5):
+        def __aiter__(self):
+            return self
+
+        @gen.coroutine
+        def __anext__(self):
+            fetched = yield self.fetch_next()
+            if not fetched:
+                raise StopAsyncIteration()
+
+            raise gen.Return(self.next_object())
+
+    def close(self):
+        """Kill the server side cursor, if it's still open"""
+        cursor_id = self._cursor_id
+        self._cursor_id = 0
+        self._in_flight.clear()
+
+        if not cursor_id:
+            return
+
+        def kill_cursor(connection):
             connection.send_message(message.kill_cursors([cursor_id]), callback=None)
 
-        if self._limit == -1 and len(response['data']) == 1:
-            callback((response['data'][0], None))
-        else:
-            callback((response['data'], None))
+        self._get_connection(callback=kill_cursor)
 
     @gen.coroutine
     def count(self):
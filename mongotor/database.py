@@ -16,16 +16,23 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from functools import partial, wraps
+from collections import deque
 from datetime import timedelta
 import six
 from tornado import gen
+from tornado import stack_context
 from tornado.ioloop import IOLoop
 from bson import SON
 from mongotor.node import Node, ReadPreference
 from mongotor.errors import DatabaseError
 from mongotor.client import Client
+from mongotor.coalescer import InsertCoalescer
+from mongotor import helpers
+import logging
 import warnings
 
+logger = logging.getLogger(__name__)
+
 
 def initialized(fn):
     @wraps(fn)
@@ -67,6 +74,71 @@ class Database(object):
           - `maxusage` (optional): number of requests allowed on a connection
             before it is closed. 0 for unlimited
           - `autoreconnect`: autoreconnect to database. default is True
+          - `multiplex` (optional): pipeline concurrent requests over shared
+            connections, matching replies by request id. default is False
+          - `max_in_flight` (optional): with `multiplex`, outstanding requests
+            per connection before another one is opened. 0 for unlimited
+          - `wait_queue_timeout` (optional): seconds to wait for a connection
+            when `maxconnections` is reached. default is 1, 0 for unlimited
+          - `max_waiters` (optional): maximum requests waiting for a
+            connection. 0 for unlimited
+          - `connect_timeout` (optional): seconds allowed to establish a
+            connection. default is 5
+          - `min_idle` (optional): idle connections kept open per node,
+            reopened in the background. default is 0 with `max_idle_time`,
+            `maxconnections` otherwise
+          - `max_idle_time` (optional): seconds a connection may stay idle
+            before it is closed, down to `min_idle`. 0 for unlimited
+          - `max_lifetime` (optional): seconds a connection is used before
+            it is replaced. 0 for unlimited
+          - `maintenance_interval` (optional): seconds between checks of
+            `min_idle`, `max_idle_time` and `max_lifetime`. default is 1
+          - `coalesce_inserts` (optional): send single document inserts
+            made together as one insert message. default is False
+          - `coalesce_window` (optional): with `coalesce_inserts`,
+            microseconds to wait for more inserts. default is 0, inserts
+            made in the same ioloop iteration are sent together
+          - `write_concern` (optional): getLastError options (``w``,
+            ``wtimeout``, ``j``, ``fsync``) for writes, e.g.
+            ``{'w': 'majority', 'wtimeout': 1000}``. ``{'w': 0}`` disables
+            acknowledgement
+          - `decode_executor` (optional): a :mod:`concurrent.futures`
+            executor used to decode large query replies off the ioloop
+          - `decode_threshold` (optional): with `decode_executor`, size
+            in bytes above which a reply is decoded in the executor.
+            default is 1MB
+          - `heartbeat_interval` (optional): seconds between checks of
+            each node state and round trip time. default is 10
+          - `local_threshold_ms` (optional): reads that may go to a
+            secondary are sent to nodes whose round trip time is within
+            this many milliseconds of the fastest one. default is 15,
+            ``None`` picks among all eligible nodes
+          - `balancing` (optional): how a node is picked among the
+            eligible ones, ``ReadPreference.RANDOM`` (default),
+            ``ReadPreference.LEAST_OUTSTANDING`` for the node with the
+            fewest requests in progress or
+            ``ReadPreference.LEAST_OUTSTANDING_RTT`` to also weigh them by
+            round trip time
+          - `tag_sets` (optional): for reads that may go to a secondary,
+            a tag set like ``{'dc': 'east'}`` or a list of them, tried in
+            order, the nodes must match
+          - `max_staleness_seconds` (optional): for reads that may go to
+            a secondary, skip those estimated to lag behind the primary
+            by more than this many seconds. Needs MongoDB 3.4 or newer.
+            At least 90, and at least `heartbeat_interval` plus 10
+          - `discover_nodes` (optional): add and remove replica set
+            members as reported by ``ismaster``, so `addresses` may be a
+            single seed. default is True
+          - `election_timeout` (optional): seconds an operation that
+            needs the primary waits for one to be elected while other
+            members are up. default is 10, 0 fails right away
+          - `max_primary_waiters` (optional): maximum operations waiting
+            for a primary. default is 1000
+          - `circuit_breaker` (optional): stop selecting a node while
+            connections to it keep failing, a dict of
+            :class:`~mongotor.breaker.CircuitBreaker` options like
+            ``{'failure_ratio': 0.5, 'reset_timeout': 5}``, ``{}`` for the
+            defaults. default is None, disabled
         """
         if cls._instance and hasattr(cls._instance, '_initialized') and cls._instance._initialized:
             return cls._instance
@@ -76,8 +148,18 @@ class Database(object):
 
         return database
 
-    def _init(self, addresses, dbname, read_preference=None, **kwargs):
+    def _init(self, addresses, dbname, read_preference=None,
+              coalesce_inserts=False, coalesce_window=0, write_concern=None,
+              decode_executor=None, decode_threshold=1024 * 1024,
+              heartbeat_interval=10,
+              local_threshold_ms=ReadPreference.LOCAL_THRESHOLD_MS,
+              balancing=ReadPreference.RANDOM, tag_sets=None,
+              max_staleness_seconds=None, discover_nodes=True,
+              election_timeout=10, max_primary_waiters=1000, circuit_breaker=None,
+              **kwargs):
         self._addresses = self._parse_addresses(addresses)
+        if not self._addresses:
+            raise ValueError('no address to connect to')
         self._dbname = dbname
         self._read_preference = read_preference or ReadPreference.PRIMARY
         self._nodes = []
@@ -85,10 +167,81 @@ class Database(object):
         self._initialized = True
         self._connected = False
         self._connect_callbacks = []
+        self._coalesce_inserts = coalesce_inserts
+        self._coalesce_window = coalesce_window
+        self._coalescers = {}
+        self._write_concern = helpers._validate_write_concern(write_concern)
+        self._decode_executor = decode_executor
+        self._decode_threshold = decode_threshold
+        self._heartbeat_interval = heartbeat_interval
+        self._local_threshold_ms = local_threshold_ms
+        self._balancing = balancing
+        self._tag_sets = helpers._validate_tag_sets(tag_sets)
+        self._max_staleness_seconds = helpers._validate_max_staleness(
+            max_staleness_seconds, heartbeat_interval)
+        self._discover_nodes = discover_nodes
+        self._monitoring = False
+        self._election_timeout = election_timeout
+        self._max_primary_waiters = max_primary_waiters
+        self._primary_waiters = deque()
+        self._circuit_breaker = circuit_breaker
 
         for host, port in self._addresses:
-            node = Node(host, port, self, self._pool_kwargs)
-            self._nodes.append(node)
+            self._add_node(host, port)
+
+    def _add_node(self, host, port):
+        node = Node(host, port, self, self._pool_kwargs,
+                    self._heartbeat_interval, self._update_topology,
+                    self._circuit_breaker)
+        self._nodes.append(node)
+
+        if self._monitoring:
+            node.monitor.start(self._on_config_node)
+
+        return node
+
+    def _remove_node(self, node):
+        self._nodes.remove(node)
+        node.disconnect()
+
+    def _update_topology(self, node, ismaster):
+        """Add the replica set members a node knows about, and remove the
+        ones the primary doesn't list anymore. Arbiters hold no data and
+        are left out.
+        """
+        if self._primary_waiters:
+            if node.is_primary:
+                self._serve_primary_waiters(node)
+            else:
+                node.monitor.request_check()  # keep looking
+
+        if not self._discover_nodes or 'setName' not in ismaster:
+            return
+
+        if node not in self._nodes:
+            return  # removed while it was being checked
+
+        members = set(self._parse_addresses(ismaster.get('hosts', []) +
+                                            ismaster.get('passives', []),
+                                            skip_invalid=True))
+
+        known = set((n.host, n.port) for n in self._nodes)
+        for host, port in members - known:
+            logger.info('discovered replica set member {0}:{1}'.format(host, port))
+            self._add_node(host, port)
+
+        if ismaster.get('ismaster'):
+            for n in list(self._nodes):
+                if (n.host, n.port) not in members:
+                    logger.info('removing replica set member {0}:{1}'.format(n.host, n.port))
+                    self._remove_node(n)
+        elif ismaster.get('primary'):
+            # a secondary knows a primary we don't, check it right away
+            for host, port in self._parse_addresses(ismaster['primary'],
+                                                   skip_invalid=True):
+                for n in self._nodes:
+                    if n.host == host and n.port == port and not n.is_primary:
+                        n.monitor.request_check()
 
     def _connect(self, callback):
         """Connect to database
@@ -101,10 +254,45 @@ class Database(object):
             self._config_nodes(callback=self._on_config_node)
 
     def _config_nodes(self, callback=None):
+        """Start monitoring every node, `callback` is called as each one
+        is checked for the first time"""
+        self._monitoring = True
+        for node in list(self._nodes):
+            node.monitor.start(callback)
+
+    def _request_topology_check(self):
+        """Check every node as soon as possible, to find a new primary"""
         for node in self._nodes:
-            node.config(callback)
+            node.monitor.request_check()
+
+    def _wait_for_primary(self, callback):
+        """Call `callback` with the primary once one is found, or with
+        ``None`` after `election_timeout` seconds"""
+        if self._max_primary_waiters and \
+                len(self._primary_waiters) >= self._max_primary_waiters:
+            raise DatabaseError('too many operations waiting for a primary')
 
-        IOLoop.instance().add_timeout(timedelta(seconds=30), self._config_nodes)
+        waiter = [stack_context.wrap(callback), None]
+        waiter[1] = IOLoop.instance().add_timeout(
+            timedelta(seconds=self._election_timeout),
+            partial(self._primary_waiter_expired, waiter))
+        self._primary_waiters.append(waiter)
+
+        self._request_topology_check()
+
+    def _primary_waiter_expired(self, waiter):
+        try:
+            self._primary_waiters.remove(waiter)
+        except ValueError:
+            return  # already served
+
+        waiter[0](None)
+
+    def _serve_primary_waiters(self, node):
+        while self._primary_waiters:
+            callback, timeout = self._primary_waiters.popleft()
+            IOLoop.instance().remove_timeout(timeout)
+            IOLoop.instance().add_callback(partial(callback, node))
 
     def _on_config_node(self):
         for node in self._nodes:
@@ -116,6 +304,21 @@ class Database(object):
             IOLoop.instance().add_callback(callback)
         self._connect_callbacks = []
 
+    def _get_coalescer(self, collection_name, check_keys, safe,
+                       last_error_args=None):
+        last_error_args = last_error_args or {}
+        key = (collection_name, check_keys, safe,
+               tuple(sorted(last_error_args.items())))
+
+        coalescer = self._coalescers.get(key)
+        if coalescer is None:
+            coalescer = InsertCoalescer(self, collection_name, check_keys,
+                                        safe, last_error_args,
+                                        self._coalesce_window)
+            self._coalescers[key] = coalescer
+
+        return coalescer
+
     @property
     def dbname(self):
         return self._dbname
@@ -124,7 +327,9 @@ class Database(object):
     def get_collection_name(self, collection):
         return '%s.%s' % (self.dbname, collection)
 
-    def _parse_addresses(self, addresses):
+    def _parse_addresses(self, addresses, skip_invalid=False):
+        """Parse ``host:port`` addresses, raising ValueError for an invalid
+        one unless `skip_invalid`, in which case it's logged and skipped"""
         if isinstance(addresses, six.string_types):
             addresses = [addresses]
 
@@ -132,8 +337,16 @@ class Database(object):
 
         parsed_addresses = []
         for address in addresses:
-            host, port = address.split(":")
-            parsed_addresses.append((host, int(port)))
+            # the host of an IPv6 address is in brackets, e.g. [::1]:27017
+            try:
+                host, port = address.rsplit(":", 1)
+                parsed_addresses.append((host.strip("[]"), int(port)))
+            except (AttributeError, ValueError):
+                if not skip_invalid:
+                    raise ValueError('invalid address {0!r}, expected host:port'
+                                     .format(address))
+                logger.error('ignoring invalid address {0!r}, expected host:port'
+                             .format(address))
 
         return parsed_addresses
 
@@ -178,7 +391,8 @@ class Database(object):
 
     @gen.engine
     @initialized
-    def get_node(self, read_preference=None, callback=None):
+    def get_node(self, read_preference=None, tag_sets=None,
+                 max_staleness_seconds=None, exclude=None, callback=None):
         assert callback
 
         # check if database is connected
@@ -188,8 +402,36 @@ class Database(object):
 
         if read_preference is None:
             read_preference = self._read_preference
+        if tag_sets is None:
+            tag_sets = self._tag_sets
+        if max_staleness_seconds is None:
+            max_staleness_seconds = self._max_staleness_seconds
+
+        nodes = self._nodes
+        if exclude:
+            nodes = [node for node in nodes if node not in exclude]
+
+        tag_sets = helpers._validate_tag_sets(tag_sets)
+        max_staleness_seconds = helpers._validate_max_staleness(
+            max_staleness_seconds, self._heartbeat_interval)
+        while True:
+            node = ReadPreference.select_node(nodes, read_preference,
+                                              self._local_threshold_ms,
+                                              self._balancing, tag_sets,
+                                              max_staleness_seconds)
+
+            # a half open circuit breaker lets a single request through
+            if node is None or node._allow_request():
+                break
+            nodes = [n for n in nodes if n is not node]
+
+        # while the other members are up, a missing primary is being elected.
+        # A primary shedding load fails right away.
+        if not node and read_preference == ReadPreference.PRIMARY and not exclude and \
+                self._election_timeout and any(n.available for n in self._nodes) and \
+                not any(n.available and n.is_primary for n in self._nodes):
+            node = yield gen.Task(self._wait_for_primary)
 
-        node = ReadPreference.select_node(self._nodes, read_preference)
         if not node:
             raise DatabaseError('could not find an available node')
 
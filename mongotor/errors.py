@@ -56,6 +56,12 @@ class IntegrityError(DatabaseError):
         self.msg = msg
 
 
+class NotMasterError(DatabaseError):
+    """Raised when a node that is no longer the primary receives an
+    operation that needs the primary.
+    """
+
+
 class ProgrammingError(DatabaseError):
     pass
 
@@ -0,0 +1,208 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Command monitoring
+
+Listeners registered with :func:`register` are told about every message
+a connection sends, and every :meth:`~mongotor.cursor.Cursor.find`, as
+it starts and once it succeeds or fails:
+
+>>> class SlowQueries(events.CommandListener):
+...     def succeeded(self, event):
+...         if event.duration > 0.1:
+...             logger.warning('slow {0} on {1}'.format(event.operation, event.namespace))
+>>> events.register(SlowQueries())
+
+Listeners are called on the ioloop, errors they raise are logged and
+ignored. Messages are only inspected while some listener is registered.
+Node heartbeats show up as ``ismaster`` commands.
+"""
+import logging
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = {
+    2001: 'update',
+    2002: 'insert',
+    2004: 'query',
+    2005: 'get_more',
+    2006: 'delete',
+    2007: 'kill_cursors',
+}
+
+_OPERATION = struct.Struct("<i")
+
+_listeners = []
+
+
+def register(listener):
+    """Register a :class:`CommandListener`"""
+    _listeners.append(listener)
+
+
+def unregister(listener):
+    _listeners.remove(listener)
+
+
+class CommandListener(object):
+    """Base class for command listeners, override the events of interest"""
+
+    def started(self, event):
+        """A :class:`CommandStartedEvent`"""
+
+    def succeeded(self, event):
+        """A :class:`CommandSucceededEvent`"""
+
+    def failed(self, event):
+        """A :class:`CommandFailedEvent`"""
+
+
+class CommandStartedEvent(object):
+    """An operation was sent.
+
+    * `operation`: ``insert``, ``update``, ``delete``, ``query``,
+      ``get_more`` or ``kill_cursors`` for messages, ``command`` for
+      queries on a ``$cmd`` collection and ``find`` for a whole
+      :meth:`~mongotor.cursor.Cursor.find`.
+    * `command_name`: the command run, with the ``command`` operation.
+    * `namespace`: the ``database.collection`` operated on.
+    * `request_id`: the id of the message answered by the server. For a
+      find, the id of its query.
+    * `address`: the ``(host, port)`` of the node, ``None`` when it
+      isn't picked yet, as when a find starts. A find ends with the
+      address of the node that answered it.
+    * `message_size`: size in bytes of the encoded message, with the
+      ``getlasterror`` query of acknowledged writes.
+    """
+
+    def __init__(self, operation, namespace, request_id, address, message_size,
+                 command_name=None):
+        self.operation = operation
+        self.command_name = command_name
+        self.namespace = namespace
+        self.request_id = request_id
+        self.address = address
+        self.message_size = message_size
+
+    def __repr__(self):
+        return '<{0} {1} {2} #{3} on {4}>'.format(
+            self.__class__.__name__, self.command_name or self.operation,
+            self.namespace, self.request_id, self.address)
+
+
+class CommandSucceededEvent(CommandStartedEvent):
+    """An operation succeeded. On top of the started event attributes:
+
+    * `reply_size`: size in bytes of the reply, or replies of a find. 0
+      when there is no reply, as for unacknowledged writes.
+    * `document_count`: documents in the reply, or returned by a find.
+    * `duration`: seconds since the operation started.
+    """
+
+    def __init__(self, started, reply_size, document_count, duration):
+        super(CommandSucceededEvent, self).__init__(
+            started.operation, started.namespace, started.request_id,
+            started.address, started.message_size, started.command_name)
+        self.reply_size = reply_size
+        self.document_count = document_count
+        self.duration = duration
+
+
+class CommandFailedEvent(CommandStartedEvent):
+    """An operation failed. On top of the started event attributes:
+
+    * `failure`: the error raised.
+    * `duration`: seconds since the operation started.
+    """
+
+    def __init__(self, started, failure, duration):
+        super(CommandFailedEvent, self).__init__(
+            started.operation, started.namespace, started.request_id,
+            started.address, started.message_size, started.command_name)
+        self.failure = failure
+        self.duration = duration
+
+
+def _publish(name, event):
+    for listener in list(_listeners):
+        try:
+            getattr(listener, name)(event)
+        except Exception:
+            logger.exception('{0!r} failed handling {1!r}'.format(listener, event))
+
+
+class _Command(object):
+    """An operation being timed, publishing its events"""
+
+    def __init__(self, event):
+        self.event = event
+        self.start = time.time()
+        _publish('started', event)
+
+    def succeeded(self, reply_size, document_count, address=None):
+        event = CommandSucceededEvent(self.event, reply_size, document_count,
+                                      time.time() - self.start)
+        if address is not None:
+            event.address = address
+        _publish('succeeded', event)
+
+    def failed(self, failure, address=None):
+        event = CommandFailedEvent(self.event, failure, time.time() - self.start)
+        if address is not None:
+            event.address = address
+        _publish('failed', event)
+
+
+def _start(operation, namespace, request_id, address, message_size):
+    """Publish the start of an operation, returning the :class:`_Command`
+    to report how it ends, or ``None`` when nobody is listening"""
+    if not _listeners:
+        return None
+
+    return _Command(CommandStartedEvent(operation, namespace, request_id, address,
+                                        message_size))
+
+
+def _cstring(data, position):
+    end = data.index(b"\x00", position)
+    return data[position:end].decode('utf-8', 'replace'), end + 1
+
+
+def _start_message(message, address):
+    """Publish the start of sending `message`, a ``(request_id, data)``
+    pair built by :mod:`mongotor.message`"""
+    if not _listeners:
+        return None
+
+    request_id, data = message
+    operation = OPERATIONS.get(_OPERATION.unpack_from(data, 12)[0], 'unknown')
+
+    namespace = command_name = None
+    if operation != 'kill_cursors':
+        # every other message has the namespace after its first field
+        namespace, position = _cstring(data, 20)
+
+        if operation == 'query' and namespace.endswith('.$cmd'):
+            # the command name is the first key of the query document,
+            # after the skip, limit, document size and element type
+            operation = 'command'
+            command_name, _ = _cstring(data, position + 13)
+
+    event = CommandStartedEvent(operation, namespace, request_id, address, len(data),
+                                command_name)
+    return _Command(event)
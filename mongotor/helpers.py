@@ -15,25 +15,75 @@
 import bson
 import struct
 import six
-from mongotor.errors import (DatabaseError,
-    InterfaceError, TimeoutError)
+from mongotor.errors import (DatabaseError, NotMasterError,
+    InterfaceError, TimeoutError, InvalidOperationError)
 from pymongo import version as PyMongoVersion
 
+try:
+    from bson.raw_bson import RawBSONDocument
+except ImportError:  # PyMongo < 3.2
+    RawBSONDocument = None
+
+
+# error codes of a node that has stepped down, or isn't the primary
+_NOT_MASTER_CODES = frozenset([10107, 13435, 13436, 10058, 11600, 11602])
+
+_REPLY_FLAGS = struct.Struct("<i")
+_REPLY_FIELDS = struct.Struct("<qii")
+
+# a primary with no writes still records one every 10 seconds, and
+# max staleness can't be reliably told apart from that below 90 seconds
+_IDLE_WRITE_PERIOD = 10
+_SMALLEST_MAX_STALENESS = 90
+
+
+def _decode_all_accepts_buffers():
+    try:
+        bson.decode_all(memoryview(bson.BSON.encode({})))
+    except TypeError:
+        return False
+    return True
+
+
+# the decoder is chosen once. PyMongo 3 dropped the as_class and tz_aware
+# arguments, and older C extensions only decode bytes, so memoryviews are
+# copied just for them
+if int(PyMongoVersion.split('.')[0]) >= 3:
+    from bson.codec_options import CodecOptions
+
+    if _decode_all_accepts_buffers():
+        def _decode_all(data, as_class, tz_aware):
+            if as_class is dict and not tz_aware:
+                return bson.decode_all(data)
+            return bson.decode_all(data, CodecOptions(as_class, tz_aware))
+    else:
+        def _decode_all(data, as_class, tz_aware):
+            if as_class is dict and not tz_aware:
+                return bson.decode_all(data.tobytes())
+            return bson.decode_all(data.tobytes(), CodecOptions(as_class, tz_aware))
+else:
+    def _decode_all(data, as_class, tz_aware):
+        return bson.decode_all(data.tobytes(), as_class, tz_aware)
+
 
 def _unpack_response(response, cursor_id=None, as_class=dict, tz_aware=False):
     """Unpack a response from the database.
 
     Check the response for errors and unpack, returning a dictionary
-    containing the response data.
+    containing the response data. The response is read through a
+    memoryview, documents are decoded without copying them first.
 
     :Parameters:
       - `response`: byte string as returned from the database
       - `cursor_id` (optional): cursor_id we sent to get this response -
         used for raising an informative exception when we get cursor id not
         valid at server response
-      - `as_class` (optional): class to use for resulting documents
+      - `as_class` (optional): class to use for resulting documents,
+        :class:`~bson.raw_bson.RawBSONDocument` leaves them undecoded
     """
-    response_flag = struct.unpack("<i", response[:4])[0]
+    response = memoryview(response)
+
+    response_flag = _REPLY_FLAGS.unpack_from(response)[0]
     if response_flag & 1:
         # Shouldn't get this response if we aren't doing a getMore
         assert cursor_id is not None
@@ -41,24 +91,38 @@ def _unpack_response(response, cursor_id=None, as_class=dict, tz_aware=False):
         raise InterfaceError("cursor id '%s' not valid at server" %
                                cursor_id)
     elif response_flag & 2:
-        error_object = bson.BSON(response[20:]).decode()
-        if error_object["$err"] == "not master":
-            raise DatabaseError("master has changed")
+        error_object = _decode_all(response[20:], dict, False)[0]
+        if _is_not_master(error_object["$err"], error_object.get("code")):
+            raise NotMasterError("master has changed", error_object.get("code"))
         raise DatabaseError("database error: %s" %
                                error_object["$err"])
 
     result = {}
-    result["cursor_id"] = struct.unpack("<q", response[4:12])[0]
-    result["starting_from"] = struct.unpack("<i", response[12:16])[0]
-    result["number_returned"] = struct.unpack("<i", response[16:20])[0]
-    if int(PyMongoVersion[0]) >= 3:
-        result["data"] = bson.decode_all(bytes(response[20:]))
-    else:
-        result["data"] = bson.decode_all(response[20:], as_class, tz_aware)
+    (result["cursor_id"], result["starting_from"],
+     result["number_returned"]) = _REPLY_FIELDS.unpack_from(response, 4)
+    result["data"] = _decode_all(response[20:], as_class, tz_aware)
     assert len(result["data"]) == result["number_returned"]
     return result
 
 
+def _reply_cursor_id(response):
+    """Get the cursor id of a reply without decoding its documents"""
+    return _REPLY_FIELDS.unpack_from(response, 4)[0]
+
+
+def _reply_number_returned(response):
+    """Get the number of documents in a reply without decoding them"""
+    return _REPLY_FIELDS.unpack_from(response, 4)[2]
+
+
+def _is_not_master(error_msg, code=None):
+    """Does an error mean the node isn't the primary anymore?"""
+    if code in _NOT_MASTER_CODES:
+        return True
+
+    return bool(error_msg) and error_msg.startswith("not master")
+
+
 def _check_command_response(response, msg="%s", allowable_errors=[]):
 
     if not response["ok"]:
@@ -76,6 +140,8 @@ def _check_command_response(response, msg="%s", allowable_errors=[]):
                     break
 
         if not details["errmsg"] in allowable_errors:
+            if _is_not_master(details["errmsg"], details.get("code")):
+                raise NotMasterError(msg % details["errmsg"], details.get("code"))
             if details["errmsg"] == "db assertion failure":
                 ex_msg = ("db assertion failure, assertion: '%s'" %
                           details.get("assertion", ""))
@@ -102,3 +168,76 @@ def _fields_list_to_dict(fields):
                             "each an instance of string (str/unicode)")
         as_dict[field] = 1
     return as_dict
+
+
+def _validate_write_concern(write_concern):
+    """Check a write concern document, returning it as a ``dict``.
+
+    Accepted options are ``w`` (a number of nodes or a tag such as
+    ``"majority"``), ``wtimeout`` (milliseconds), ``j`` and ``fsync``.
+    """
+    if write_concern is None:
+        return None
+
+    if not isinstance(write_concern, dict):
+        raise TypeError("write_concern must be an instance of dict")
+
+    for option in write_concern:
+        if option not in ('w', 'wtimeout', 'j', 'fsync'):
+            raise InvalidOperationError("%s is not a valid write concern option" % option)
+
+    w = write_concern.get('w')
+    if w is not None and not isinstance(w, (six.integer_types, six.string_types)):
+        raise TypeError("w must be an integer or a string")
+
+    if 'wtimeout' in write_concern and \
+            not isinstance(write_concern['wtimeout'], six.integer_types):
+        raise TypeError("wtimeout must be an integer")
+
+    if write_concern.get('w') == 0 and (write_concern.get('j') or write_concern.get('fsync')):
+        raise InvalidOperationError("cannot combine w=0 with j or fsync")
+
+    return dict(write_concern)
+
+
+def _validate_tag_sets(tag_sets):
+    """Check read preference tag sets, returning them as a list of ``dict``.
+
+    A single ``dict`` is taken as a list with one tag set. The empty tag
+    set ``{}`` matches any node.
+    """
+    if tag_sets is None:
+        return None
+
+    if isinstance(tag_sets, dict):
+        tag_sets = [tag_sets]
+
+    if not isinstance(tag_sets, (list, tuple)):
+        raise TypeError("tag_sets must be a dict or a list of dicts")
+
+    for tag_set in tag_sets:
+        if not isinstance(tag_set, dict):
+            raise TypeError("tag_sets must be a dict or a list of dicts")
+
+    return list(tag_sets)
+
+
+def _validate_max_staleness(max_staleness_seconds, heartbeat_interval):
+    """Check a max staleness, returning it unchanged.
+
+    It can't be smaller than 90 seconds, nor than `heartbeat_interval`
+    plus the 10 seconds a primary may go without writing.
+    """
+    if max_staleness_seconds is None:
+        return None
+
+    if isinstance(max_staleness_seconds, bool) or \
+            not isinstance(max_staleness_seconds, six.integer_types + (float,)):
+        raise TypeError("max_staleness_seconds must be a number")
+
+    smallest = max(_SMALLEST_MAX_STALENESS, heartbeat_interval + _IDLE_WRITE_PERIOD)
+    if max_staleness_seconds < smallest:
+        raise InvalidOperationError("max_staleness_seconds must be at least %s "
+                                    "seconds" % smallest)
+
+    return max_staleness_seconds
@@ -20,7 +20,7 @@ MongoDB.
    application developers.
 """
 
-import random
+import itertools
 import struct
 
 import bson
@@ -30,43 +30,121 @@ from mongotor.errors import InvalidOperationError
 
 __ZERO = b"\x00\x00\x00\x00"
 
+# messages are assembled as a list of parts and joined once, the first
+# part is a placeholder for the header which is packed when the size is known
+__HEADER = struct.Struct("<iiii")
+__INT = struct.Struct("<i")
+__UINT = struct.Struct("<I")
+__SKIP_AND_LIMIT = struct.Struct("<ii")
+__GET_MORE = struct.Struct("<iq")
 
-def __last_error(args):
-    """Data to send to do a lastError.
+__request_ids = itertools.count(1)
+
+
+def __next_request_id():
+    return next(__request_ids) & 0x7FFFFFFF
+
+
+def __frame(operation, parts):
+    """Fill the header placeholder of `parts` for the given operation.
+
+    Returns the request id and the parts.
     """
-    cmd = SON([("getlasterror", 1)])
-    cmd.update(args)
-    return query(0, "admin.$cmd", 0, -1, cmd)
+    request_id = __next_request_id()
+    length = 16
+    for part in parts[1:]:
+        length += len(part)
+    parts[0] = __HEADER.pack(length, request_id, 0, operation)
+    return request_id, parts
+
 
+def __pack_message(operation, parts):
+    """Takes message parts and adds a message header based on the operation.
+
+    Returns the request id and the resultant message string.
+    """
+    request_id, parts = __frame(operation, parts)
+    return (request_id, b"".join(parts))
 
-def __pack_message(operation, data):
-    """Takes message data and adds a message header based on the operation.
 
-    Returns the resultant message string.
+def __with_last_error(operation, parts, last_error_args):
+    """Pack a write message followed by a lastError query, returning the
+    request id of the query, which is the one answered by the server.
     """
-    request_id = random.randint(-2 ** 31 - 1, 2 ** 31)
-    message = struct.pack("<i", 16 + len(data))
-    message += struct.pack("<i", request_id)
-    message += __ZERO  # responseTo
-    message += struct.pack("<i", operation)
-    return (request_id, message + data)
+    _, parts = __frame(operation, parts)
+
+    cmd = SON([("getlasterror", 1)])
+    cmd.update(last_error_args)
+    request_id, error_parts = __frame(2004, __query_parts(0, "admin.$cmd", 0, -1, cmd))
+
+    parts.extend(error_parts)
+    return (request_id, b"".join(parts))
+
+
+def __write_message(operation, parts, safe, last_error_args):
+    if safe:
+        return __with_last_error(operation, parts, last_error_args)
+    return __pack_message(operation, parts)
+
 
+def __insert_message(collection_name, bson_data, safe, last_error_args,
+                     continue_on_error):
+    parts = [None,
+             __INT.pack(1 if continue_on_error else 0),
+             bson._make_c_string(collection_name)]
+    parts.extend(bson_data)
+    return __write_message(2002, parts, safe, last_error_args)
 
-def insert(collection_name, docs, check_keys, safe, last_error_args):
+
+def insert(collection_name, docs, check_keys, safe, last_error_args,
+           continue_on_error=False):
     """Get an **insert** message.
     """
-    data = __ZERO
-    data += bson._make_c_string(collection_name)
-    bson_data = b"".join([bson.BSON.encode(doc, check_keys) for doc in docs])
+    bson_data = [bson.BSON.encode(doc, check_keys) for doc in docs]
     if not bson_data:
         raise InvalidOperationError("cannot do an empty bulk insert")
-    data += bson_data
-    if safe:
-        (_, insert_message) = __pack_message(2002, data)
-        (request_id, error_message) = __last_error(last_error_args)
-        return (request_id, insert_message + error_message)
-    else:
-        return __pack_message(2002, data)
+    return __insert_message(collection_name, bson_data, safe,
+                            last_error_args, continue_on_error)
+
+
+def insert_batches(collection_name, docs, check_keys, safe, last_error_args,
+                   continue_on_error, max_bson_size, max_message_size):
+    """Split `docs` into the fewest **insert** messages allowed by the
+    server limits.
+
+    `docs` may be any iterable, it is encoded lazily. Documents already
+    encoded as :class:`~bson.BSON` are sent as they are. Yields
+    ``(message, number of documents)`` pairs.
+    """
+    # header, flags and collection name are sent with every message
+    max_data_size = max_message_size - 20 - len(bson._make_c_string(collection_name))
+
+    batch = []
+    batch_size = 0
+    for doc in docs:
+        if isinstance(doc, bson.BSON):
+            encoded = doc
+        else:
+            encoded = bson.BSON.encode(doc, check_keys)
+        if len(encoded) > max_bson_size:
+            raise InvalidOperationError("document too large (%d bytes), the "
+                                        "maximum size is %d bytes" %
+                                        (len(encoded), max_bson_size))
+
+        if batch and batch_size + len(encoded) > max_data_size:
+            yield (__insert_message(collection_name, batch, safe,
+                                    last_error_args, continue_on_error), len(batch))
+            batch = []
+            batch_size = 0
+
+        batch.append(encoded)
+        batch_size += len(encoded)
+
+    if not batch:
+        raise InvalidOperationError("cannot do an empty bulk insert")
+
+    yield (__insert_message(collection_name, batch, safe,
+                            last_error_args, continue_on_error), len(batch))
 
 
 def update(collection_name, upsert, multi, spec, doc, safe, last_error_args):
@@ -78,63 +156,62 @@ def update(collection_name, upsert, multi, spec, doc, safe, last_error_args):
     if multi:
         options += 2
 
-    data = __ZERO
-    data += bson._make_c_string(collection_name)
-    data += struct.pack("<i", options)
-    data += bson.BSON.encode(spec)
-    data += bson.BSON.encode(doc)
-    if safe:
-        (_, update_message) = __pack_message(2001, data)
-        (request_id, error_message) = __last_error(last_error_args)
-        return (request_id, update_message + error_message)
-    else:
-        return __pack_message(2001, data)
+    parts = [None,
+             __ZERO,
+             bson._make_c_string(collection_name),
+             __INT.pack(options),
+             bson.BSON.encode(spec),
+             bson.BSON.encode(doc)]
+    return __write_message(2001, parts, safe, last_error_args)
+
+
+def __query_parts(options, collection_name, num_to_skip, num_to_return,
+                  query, field_selector=None):
+    parts = [None,
+             __UINT.pack(options),
+             bson._make_c_string(collection_name),
+             __SKIP_AND_LIMIT.pack(num_to_skip, num_to_return),
+             bson.BSON.encode(query)]
+    if field_selector is not None:
+        parts.append(bson.BSON.encode(field_selector))
+    return parts
 
 
 def query(options, collection_name,
           num_to_skip, num_to_return, query, field_selector=None):
     """Get a **query** message.
     """
-    data = struct.pack("<I", options)
-    data += bson._make_c_string(collection_name)
-    data += struct.pack("<i", num_to_skip)
-    data += struct.pack("<i", num_to_return)
-    data += bson.BSON.encode(query)
-    if field_selector is not None:
-        data += bson.BSON.encode(field_selector)
-    return __pack_message(2004, data)
+    return __pack_message(2004, __query_parts(options, collection_name,
+                                              num_to_skip, num_to_return,
+                                              query, field_selector))
 
 
 def get_more(collection_name, num_to_return, cursor_id):
     """Get a **getMore** message.
     """
-    data = __ZERO
-    data += bson._make_c_string(collection_name)
-    data += struct.pack("<i", num_to_return)
-    data += struct.pack("<q", cursor_id)
-    return __pack_message(2005, data)
+    parts = [None,
+             __ZERO,
+             bson._make_c_string(collection_name),
+             __GET_MORE.pack(num_to_return, cursor_id)]
+    return __pack_message(2005, parts)
 
 
 def delete(collection_name, spec, safe, last_error_args):
     """Get a **delete** message.
     """
-    data = __ZERO
-    data += bson._make_c_string(collection_name)
-    data += __ZERO
-    data += bson.BSON.encode(spec)
-    if safe:
-        (_, remove_message) = __pack_message(2006, data)
-        (request_id, error_message) = __last_error(last_error_args)
-        return (request_id, remove_message + error_message)
-    else:
-        return __pack_message(2006, data)
+    parts = [None,
+             __ZERO,
+             bson._make_c_string(collection_name),
+             __ZERO,
+             bson.BSON.encode(spec)]
+    return __write_message(2006, parts, safe, last_error_args)
 
 
 def kill_cursors(cursor_ids):
     """Get a **killCursors** message.
     """
-    data = __ZERO
-    data += struct.pack("<i", len(cursor_ids))
-    for cursor_id in cursor_ids:
-        data += struct.pack("<q", cursor_id)
-    return __pack_message(2007, data)
+    parts = [None,
+             __ZERO,
+             __INT.pack(len(cursor_ids)),
+             struct.pack("<%dq" % len(cursor_ids), *cursor_ids)]
+    return __pack_message(2007, parts)
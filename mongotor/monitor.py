@@ -0,0 +1,191 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+import time
+from datetime import timedelta
+from bson import SON
+from tornado import gen
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+from mongotor.connection import Connection
+from mongotor.errors import Error
+from mongotor import message
+from mongotor import helpers
+
+logger = logging.getLogger(__name__)
+
+# weight of the newest sample in the round trip time average
+RTT_ALPHA = 0.2
+
+# immediate checks never run more often than this, in seconds
+MIN_HEARTBEAT_INTERVAL = 0.5
+
+
+class NodeMonitor(object):
+    """Checks a node with ``ismaster`` every `interval` seconds
+
+    The monitor has a connection of its own, so a node is checked even
+    when its pool is exhausted. Every reply updates the node state and
+    the moving average of its round trip time. A check that takes more
+    than `timeout` seconds marks the node unavailable.
+
+    :meth:`request_check` runs a check as soon as possible, it's called
+    when a connection to the node is lost.
+
+    `on_ismaster` is called with the node and every ``ismaster`` reply
+    once the node is updated.
+    """
+
+    def __init__(self, node, interval=10, timeout=5, on_ismaster=None):
+        self._node = node
+        self._on_ismaster = on_ismaster
+        self._interval = interval
+        self._timeout = timeout
+        self._connection = None
+        self._running = False
+        self._checking = False
+        self._last_check = None
+        self._next_check = None
+        self._callbacks = []
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self, callback=None):
+        """Start checking the node, `callback` is called after the first check"""
+        if self._running:
+            if callback:
+                self.check(callback)
+            return
+
+        self._running = True
+        self.check(callback)
+
+    def stop(self):
+        self._running = False
+        self._cancel_next_check()
+
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+
+    def request_check(self):
+        """Check the node now instead of waiting for the next heartbeat"""
+        if not self._running or self._checking:
+            return
+
+        delay = 0
+        if self._last_check is not None:
+            delay = max(0, self._last_check + MIN_HEARTBEAT_INTERVAL - time.time())
+
+        self._schedule(delay)
+
+    def _schedule(self, delay):
+        self._cancel_next_check()
+        with stack_context.NullContext():
+            self._next_check = IOLoop.instance().add_timeout(
+                timedelta(seconds=delay), self.check)
+
+    def _cancel_next_check(self):
+        if self._next_check:
+            IOLoop.instance().remove_timeout(self._next_check)
+            self._next_check = None
+
+    def check(self, callback=None):
+        """Run a check now, `callback` is called once the node is updated"""
+        if callback:
+            self._callbacks.append(stack_context.wrap(callback))
+
+        if self._checking:
+            return
+
+        self._checking = True
+        self._cancel_next_check()
+
+        with stack_context.NullContext():
+            self._check()
+
+    @gen.engine
+    def _check(self):
+        was_available = self._node.available
+        response = None
+        timeout = None
+        try:
+            if self._connection is None:
+                self._connection = Connection(self._node.host, self._node.port,
+                                              timeout=self._timeout)
+
+            ismaster = message.query(0, 'admin.$cmd', 0, -1, SON([('ismaster', 1)]))
+            timeout = IOLoop.instance().add_timeout(timedelta(seconds=self._timeout),
+                                                    self._on_check_timeout)
+
+            # a (re)connect must not count in the round trip time
+            error = yield gen.Task(self._connection.ready)
+            if error:
+                raise error
+
+            start = time.time()
+            reply, error = yield gen.Task(self._connection.send_message_with_response,
+                                          ismaster)
+            if error:
+                raise error
+
+            reply = helpers._unpack_response(reply)['data'][0]
+            self._node._update(reply, time.time() - start)
+            response = reply
+        except Exception as error:
+            if isinstance(error, Error):
+                logger.error('oops, database node {host}:{port} is unavailable: {error}'
+                             .format(host=self._node.host, port=self._node.port, error=error))
+            else:
+                logger.exception('oops, database node {host}:{port} check failed'
+                                 .format(host=self._node.host, port=self._node.port))
+            self._node._mark_unavailable()
+        finally:
+            if timeout is not None:
+                IOLoop.instance().remove_timeout(timeout)
+            self._finish_check(was_available, response)
+
+    def _finish_check(self, was_available, response):
+        self._last_check = time.time()
+        self._checking = False
+
+        try:
+            if self._running:
+                # a node that just went away is checked again right away, in
+                # case it was only a dropped connection
+                if was_available and not response:
+                    self._schedule(MIN_HEARTBEAT_INTERVAL)
+                else:
+                    self._schedule(self._interval)
+
+            # may ask for another check right away
+            if response and self._on_ismaster:
+                self._on_ismaster(self._node, response)
+        except Exception:
+            logger.exception('error handling ismaster from {0}:{1}'
+                             .format(self._node.host, self._node.port))
+        finally:
+            callbacks, self._callbacks = self._callbacks, []
+            for callback in callbacks:
+                callback()
+
+    def _on_check_timeout(self):
+        if self._connection:
+            logger.error('{0}:{1} ismaster timed out'.format(self._node.host, self._node.port))
+            self._connection.close()
@@ -15,23 +15,30 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import calendar
 import logging
 import random
+import time
 import six
-from tornado import gen
-from bson import SON
 from mongotor.pool import ConnectionPool
-from mongotor.connection import Connection
-from mongotor.errors import InterfaceError, TooManyConnections
+from mongotor.monitor import NodeMonitor, RTT_ALPHA
+from mongotor.breaker import CircuitBreaker
 
 logger = logging.getLogger(__name__)
 
+MAX_BSON_SIZE = 16 * 1024 * 1024
+
 
 class Node(object):
     """Node of database cluster
+
+    With `circuit_breaker`, a dict of
+    :class:`~mongotor.breaker.CircuitBreaker` options, the node stops
+    being selected while requests to it keep failing.
     """
 
-    def __init__(self, host, port, database, pool_kargs=None):
+    def __init__(self, host, port, database, pool_kargs=None, heartbeat_interval=10,
+                 on_ismaster=None, circuit_breaker=None):
         if not pool_kargs:
             pool_kargs = {}
 
@@ -42,47 +49,92 @@ class Node(object):
         self.port = port
         self.database = database
         self.pool_kargs = pool_kargs
+        self.heartbeat_interval = heartbeat_interval
 
         self.is_primary = False
         self.is_secondary = False
         self.available = False
         self.initialized = False
 
+        # limits reported by the server, for servers that don't report them
+        self.max_bson_size = MAX_BSON_SIZE
+        self.max_message_size = 2 * MAX_BSON_SIZE
+
+        # moving average of the ismaster round trip time, in seconds
+        self.round_trip_time = None
+
+        self.tags = {}
+        # when the node was last checked and the time of its last write,
+        # reported by servers >= 3.4, as seconds since the epoch
+        self.last_update_time = None
+        self.last_write_time = None
+
         self.pool = ConnectionPool(self.host, self.port, self.database.dbname,
+                                   on_connection_lost=self._on_connection_lost,
+                                   on_not_master=self._on_not_master,
+                                   on_reply=self._on_reply,
                                    **self.pool_kargs)
+        self.monitor = NodeMonitor(self, heartbeat_interval,
+                                   self.pool_kargs.get('connect_timeout', 5),
+                                   on_ismaster)
+
+        self.breaker = None
+        if circuit_breaker is not None:
+            self.breaker = CircuitBreaker(name='{0}:{1}'.format(host, port),
+                                          **circuit_breaker)
 
-    @gen.engine
     def config(self, callback=None):
-        ismaster = SON([('ismaster', 1)])
-
-        response = None
-        try:
-            try:
-                connection = yield gen.Task(self.connection)
-            except TooManyConnections:
-                # create a connection on the fly if pool is full
-                connection = Connection(host=self.host, port=self.port)
-            response, error = yield gen.Task(self.database._command, ismaster,
-                                             connection=connection)
-            if not connection._pool:  # if connection is created on the fly
-                connection.close()
-        except InterfaceError as ie:
-            logger.error('oops, database node {host}:{port} is unavailable: {error}'
-                         .format(host=self.host, port=self.port, error=ie))
-
-        if response:
-            self.is_primary = response.get('ismaster', True)
-            self.is_secondary = response.get('secondary', False)
-            self.available = True
+        """Check the node now, `callback` is called once it's updated"""
+        self.monitor.check(callback)
+
+    def _update(self, response, round_trip_time):
+        """Update the node from an ``ismaster`` reply"""
+        self.is_primary = response.get('ismaster', True)
+        self.is_secondary = response.get('secondary', False)
+        self.max_bson_size = response.get('maxBsonObjectSize', MAX_BSON_SIZE)
+        self.max_message_size = response.get('maxMessageSizeBytes',
+                                             2 * self.max_bson_size)
+        if self.round_trip_time is None:
+            self.round_trip_time = round_trip_time
         else:
-            self.available = False
+            self.round_trip_time = RTT_ALPHA * round_trip_time + \
+                (1 - RTT_ALPHA) * self.round_trip_time
+        self.tags = response.get('tags', {})
+        self.last_update_time = time.time()
+
+        last_write_date = response.get('lastWrite', {}).get('lastWriteDate')
+        if last_write_date is not None:
+            self.last_write_time = calendar.timegm(last_write_date.utctimetuple()) + \
+                last_write_date.microsecond / 1e6
+        self.available = True
+        self.initialized = True
 
+    def _mark_unavailable(self):
+        self.available = False
+        self.round_trip_time = None
         self.initialized = True
 
-        if callback:
-            callback()
+    def _on_reply(self, sent_at=None):
+        if self.breaker:
+            self.breaker.record_success(sent_at)
+
+    def _on_connection_lost(self, sent_at=None):
+        if self.breaker:
+            self.breaker.record_failure(sent_at)
+
+        if self.is_primary:
+            self._on_not_master()
+        else:
+            self.monitor.request_check()
+
+    def _on_not_master(self):
+        """The node may have stepped down, stop sending it operations that
+        need the primary and look for the new one right away"""
+        self.is_primary = False
+        self.database._request_topology_check()
 
     def disconnect(self):
+        self.monitor.stop()
         self.pool.close()
 
     def __repr__(self):
@@ -90,6 +142,21 @@ class Node(object):
             .format(host=self.host, port=self.port, primary=self.is_primary,
                     secondary=self.is_secondary)
 
+    @property
+    def selectable(self):
+        """Whether the node is up and its circuit breaker lets requests through"""
+        return self.available and (self.breaker is None or
+                                   self.breaker.allows_requests())
+
+    def _allow_request(self):
+        """Take the circuit breaker probe, if it's the node turn to get one"""
+        return self.breaker is None or self.breaker.allow()
+
+    @property
+    def outstanding(self):
+        """Number of requests in progress on this node"""
+        return self.pool.outstanding
+
     def connection(self, callback):
         """Return one connection from pool
         """
@@ -106,7 +173,22 @@ class ReadPreference(object):
       is raised if no secondaries are available.
     * `SECONDARY_PREFERRED`: Queries are distributed among secondaries,
       or the primary if no secondary is available.
-    * TODO: `NEAREST`: Queries are distributed among all members.
+    * `NEAREST`: Queries are distributed among all members.
+
+    Nodes whose circuit breaker is open are never selected.
+
+    Secondaries and `NEAREST` members can be narrowed down with
+    `tag_sets`, a list of tag sets tried in order until one matches some
+    node, and `max_staleness_seconds`, to skip secondaries estimated to
+    lag behind the primary by more than that. They are then only picked
+    among the nodes whose round trip time is within `local_threshold_ms`
+    milliseconds of the fastest eligible node. Then, depending on
+    `balancing`:
+
+    * `RANDOM`: any of them is picked.
+    * `LEAST_OUTSTANDING`: the one with the fewest requests in progress.
+    * `LEAST_OUTSTANDING_RTT`: the one with the fewest requests in
+      progress weighted by its round trip time.
     """
 
     PRIMARY = 0
@@ -114,20 +196,32 @@ class ReadPreference(object):
     SECONDARY = 2
     SECONDARY_ONLY = 2
     SECONDARY_PREFERRED = 3
-    #NEAREST = 4
+    NEAREST = 4
+
+    LOCAL_THRESHOLD_MS = 15
+
+    RANDOM = 0
+    LEAST_OUTSTANDING = 1
+    LEAST_OUTSTANDING_RTT = 2
 
     @classmethod
     def select_primary_node(cls, nodes):
         for node in nodes:
-            if node.available and node.is_primary:
+            if node.selectable and node.is_primary:
                 return node
 
     @classmethod
-    def select_random_node(cls, nodes, secondary_only):
+    def select_random_node(cls, nodes, secondary_only,
+                           local_threshold_ms=LOCAL_THRESHOLD_MS, balancing=RANDOM,
+                           tag_sets=None, max_staleness_seconds=None):
         candidates = []
 
         for node in nodes:
-            if not node.available:
+            if not node.selectable:
+                continue
+
+            # arbiters and members recovering or starting up can't serve reads
+            if not (node.is_primary or node.is_secondary):
                 continue
 
             if secondary_only and node.is_primary:
@@ -135,13 +229,128 @@ class ReadPreference(object):
 
             candidates.append(node)
 
+        if max_staleness_seconds is not None:
+            candidates = cls.fresh_nodes(nodes, candidates, max_staleness_seconds)
+
+        if tag_sets:
+            candidates = cls.matching_tag_sets(candidates, tag_sets)
+
         if not candidates:
             return None
 
-        return random.choice(candidates)
+        candidates = cls.latency_window(candidates, local_threshold_ms)
+        if balancing == cls.RANDOM or len(candidates) == 1:
+            return random.choice(candidates)
+
+        return cls.least_outstanding(candidates, balancing == cls.LEAST_OUTSTANDING_RTT)
 
     @classmethod
-    def select_node(cls, nodes, mode=None):
+    def matching_tag_sets(cls, nodes, tag_sets):
+        """Get the nodes matching the first tag set that matches any node"""
+        for tag_set in tag_sets:
+            matching = [node for node in nodes
+                        if all(node.tags.get(tag) == value
+                               for tag, value in six.iteritems(tag_set))]
+            if matching:
+                return matching
+
+        return []
+
+    @classmethod
+    def staleness(cls, node, primary, freshest):
+        """Estimate how many seconds `node` lags behind the primary, from
+        the last write times reported to the node monitors. Returns
+        ``None`` when the server doesn't report them.
+        """
+        if node.is_primary:
+            return 0
+
+        if node.last_write_time is None:
+            return None
+
+        if primary is not None and primary.last_write_time is not None:
+            return (node.last_update_time - node.last_write_time) - \
+                (primary.last_update_time - primary.last_write_time) + \
+                node.heartbeat_interval
+
+        if freshest is not None:
+            return freshest.last_write_time - node.last_write_time + \
+                node.heartbeat_interval
+
+        return None
+
+    @classmethod
+    def fresh_nodes(cls, nodes, candidates, max_staleness_seconds):
+        """Get the `candidates` not estimated to be more than
+        `max_staleness_seconds` behind the primary. Nodes whose
+        staleness can't be estimated are kept.
+        """
+        primary = None
+        for node in nodes:
+            if node.available and node.is_primary:
+                primary = node
+
+        freshest = None
+        for node in nodes:
+            if node.available and node.is_secondary and node.last_write_time is not None:
+                if freshest is None or node.last_write_time > freshest.last_write_time:
+                    freshest = node
+
+        fresh = []
+        for node in candidates:
+            staleness = cls.staleness(node, primary, freshest)
+            if staleness is None or staleness <= max_staleness_seconds:
+                fresh.append(node)
+
+        return fresh
+
+    @classmethod
+    def least_outstanding(cls, nodes, weighted=False):
+        """Get the node with the fewest requests in progress, ties are
+        broken at random. When `weighted`, each request in progress counts
+        as much as the node round trip time.
+        """
+        default_rtt = 0
+        if weighted:
+            measured = [node.round_trip_time for node in nodes
+                        if node.round_trip_time is not None]
+            default_rtt = min(measured) if measured else 0
+
+        def load(node):
+            if not weighted:
+                return node.outstanding
+
+            rtt = node.round_trip_time
+            if rtt is None:
+                rtt = default_rtt
+            return (node.outstanding + 1) * rtt
+
+        loads = [(load(node), node) for node in nodes]
+        lowest = min(node_load for node_load, _ in loads)
+
+        return random.choice([node for node_load, node in loads if node_load == lowest])
+
+    @classmethod
+    def latency_window(cls, nodes, local_threshold_ms=LOCAL_THRESHOLD_MS):
+        """Get the nodes whose round trip time is within
+        `local_threshold_ms` of the fastest one. Nodes not measured yet
+        are kept.
+        """
+        if local_threshold_ms is None:
+            return nodes
+
+        measured = [node.round_trip_time for node in nodes
+                    if node.round_trip_time is not None]
+        if not measured:
+            return nodes
+
+        limit = min(measured) + local_threshold_ms / 1000.0
+        return [node for node in nodes
+                if node.round_trip_time is None or node.round_trip_time <= limit]
+
+    @classmethod
+    def select_node(cls, nodes, mode=None, local_threshold_ms=LOCAL_THRESHOLD_MS,
+                    balancing=RANDOM, tag_sets=None, max_staleness_seconds=None):
         if mode is None:
             mode = cls.PRIMARY
 
@@ -153,14 +362,22 @@ class ReadPreference(object):
             if primary_node:
                 return primary_node
             else:
-                return cls.select_node(nodes, cls.SECONDARY)
+                return cls.select_node(nodes, cls.SECONDARY, local_threshold_ms,
+                                       balancing, tag_sets, max_staleness_seconds)
 
         if mode == cls.SECONDARY:
-            return cls.select_random_node(nodes, secondary_only=True)
+            return cls.select_random_node(nodes, True, local_threshold_ms, balancing,
+                                          tag_sets, max_staleness_seconds)
 
         if mode == cls.SECONDARY_PREFERRED:
-            secondary_node = cls.select_random_node(nodes, secondary_only=True)
+            secondary_node = cls.select_random_node(nodes, True, local_threshold_ms,
+                                                    balancing, tag_sets,
+                                                    max_staleness_seconds)
             if secondary_node:
                 return secondary_node
             else:
                 return cls.select_primary_node(nodes)
+
+        if mode == cls.NEAREST:
+            return cls.select_random_node(nodes, False, local_threshold_ms, balancing,
+                                          tag_sets, max_staleness_seconds)
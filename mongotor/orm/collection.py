@@ -76,7 +76,14 @@ class Collection(object):
     If you do not specify `__collection__` attribute, it is
     auto-generated from class name. Camel case is converted
     to snake case. For example: CamelCase -> camel_case.
+
+    Writes use the database write concern unless the class sets
+    `__write_concern__`:
+
+    >>> class Events(collection.Collection):
+    >>>     __write_concern__ = {'w': 1, 'j': False}
     """
+    __write_concern__ = None
     _fields_name_to_attr = {}  # maps field database name to field attr name
                                # will be filled in metaclass
 
@@ -146,7 +153,8 @@ class Collection(object):
         return instance
 
     def get_client(self):
-        return Client(Database(), self.__collection__)
+        return Client(Database(), self.__collection__,
+                      write_concern=self.__write_concern__)
 
     @gen.coroutine
     def save(self, safe=True, check_keys=True):
@@ -52,7 +52,8 @@ class Manager(object):
 
     @gen.coroutine
     def remove(self, *args, **kwargs):
-        client = Client(Database(), self.collection.__collection__)
+        client = Client(Database(), self.collection.__collection__,
+                        write_concern=self.collection.__write_concern__)
         result, error = yield gen.Task(client.remove, *args, **kwargs)
         raise gen.Return(result)
 
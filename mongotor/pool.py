@@ -15,17 +15,23 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import logging
+import time
 from datetime import timedelta
-from threading import Condition
+from collections import deque
 import six
 from tornado.ioloop import IOLoop
+from tornado import stack_context
 from functools import partial
 from mongotor.connection import Connection
-from mongotor.errors import TooManyConnections
+from mongotor.errors import TooManyConnections, InterfaceError
 
 log = logging.getLogger(__name__)
 
 
+def _raise(error):
+    raise error
+
+
 class ConnectionPool(object):
     """Connection Pool
 
@@ -34,10 +40,40 @@ class ConnectionPool(object):
       - `maxusage` (optional): number of requests allowed on a connection before it is closed. 0 for unlimited
       - `dbname`: mongo database name
       - `autoreconnect`: autoreconnect on database
+      - `multiplex` (optional): share connections between concurrent
+        requests instead of checking them out one request at a time
+      - `max_in_flight` (optional): with `multiplex`, number of outstanding
+        requests on a connection before the pool opens another one. 0 for unlimited
+      - `wait_queue_timeout` (optional): seconds a request waits for a
+        connection when `maxconnections` is reached before
+        :class:`~mongotor.errors.TooManyConnections` is raised. 0 for unlimited
+      - `max_waiters` (optional): maximum requests waiting for a
+        connection. 0 for unlimited
+      - `connect_timeout` (optional): seconds allowed to establish a connection
+      - `on_connection_lost` (optional): called when a connection is
+        closed by the server or can't be established, with the time the
+        connection last sent a request or was opened
+      - `on_not_master` (optional): called when a connection finds the
+        node is not the primary anymore
+      - `on_reply` (optional): called when a connection receives a reply,
+        with the time the request was sent
+      - `min_idle` (optional): idle connections kept open, reopened in
+        the background when they are closed. defaults to 0 when
+        `max_idle_time` is given, otherwise to `maxconnections`, all of
+        them opened when the pool is created
+      - `max_idle_time` (optional): seconds a connection may stay idle
+        before it is closed, unless it's needed to keep `min_idle`. 0 for unlimited
+      - `max_lifetime` (optional): seconds a connection is used before it
+        is closed and replaced. 0 for unlimited
+      - `maintenance_interval` (optional): seconds between checks of the
+        settings above, which only run when one of them is given
 
     """
     def __init__(self, host, port, dbname, maxconnections=0, maxusage=0,
-                 autoreconnect=True):
+                 autoreconnect=True, multiplex=False, max_in_flight=0,
+                 wait_queue_timeout=1, max_waiters=0, connect_timeout=5,
+                 on_connection_lost=None, on_not_master=None, on_reply=None,
+                 min_idle=None, max_idle_time=0, max_lifetime=0, maintenance_interval=1):
 
         assert isinstance(host, six.string_types)
         assert isinstance(port, int)
@@ -45,97 +81,328 @@ class ConnectionPool(object):
         assert isinstance(maxusage, int)
         assert isinstance(dbname, six.string_types)
         assert isinstance(autoreconnect, bool)
+        assert isinstance(multiplex, bool)
+        assert isinstance(max_in_flight, int)
+        assert isinstance(wait_queue_timeout, (int, float))
+        assert isinstance(max_waiters, int)
+        assert isinstance(connect_timeout, (int, float))
+        assert min_idle is None or isinstance(min_idle, int)
+        assert isinstance(max_idle_time, (int, float))
+        assert isinstance(max_lifetime, (int, float))
 
         self._host = host
         self._port = port
         self._maxconnections = maxconnections
         self._maxusage = maxusage
         self._autoreconnect = autoreconnect
+        self._multiplex = multiplex
+        self._max_in_flight = max_in_flight
+        self._wait_queue_timeout = wait_queue_timeout
+        self._max_waiters = max_waiters
+        self._connect_timeout = connect_timeout
+        self._on_connection_lost = on_connection_lost
+        self._on_not_master = on_not_master
+        self._on_reply = on_reply
+        # the maintenance task only runs for the settings it enforces
+        maintain = min_idle is not None or max_idle_time or max_lifetime
+        if min_idle is None:
+            # idle connections could never be closed if all must be kept
+            min_idle = 0 if max_idle_time else maxconnections
+        self._min_idle = min_idle
+        self._max_idle_time = max_idle_time
+        self._max_lifetime = max_lifetime
+        self._maintenance_interval = maintenance_interval
+        self._maintenance = None
+        self._closed = False
+        # everything happens on the ioloop thread, so there are no locks.
+        # Idle connections are reused last in first out, keeping the
+        # sockets in use warm and letting the others go idle
         self._connections = 0
-        self._idle_connections = []
-        self._condition = Condition()
+        self._checked_out = set()
+        self._idle_connections = deque()
+        self._shared_connections = []
+        self._waiters = deque()
 
-        for i in range(self._maxconnections):
-            conn = self._create_connection()
-            self._idle_connections.append(conn)
+        # connections are opened asynchronously
+        self._fill()
+
+        if maintain:
+            self._schedule_maintenance()
 
     def __repr__(self):
         return "ConnectionPool {0}:{1}:{2} using:{3}, idle:{4} :::: "\
             .format(id(self), self._host, self._port, self._connections, len(self._idle_connections))
 
+    @property
+    def outstanding(self):
+        """Number of requests using or waiting for a connection"""
+        if self._multiplex:
+            return sum(conn.in_flight for conn in self._shared_connections)
+
+        return self._connections + len(self._waiters)
+
     def _create_connection(self):
-        log.debug('{0} creating new connection'.format(self))
+        log.debug('%s creating new connection', self)
         return Connection(host=self._host, port=self._port, pool=self,
-                          autoreconnect=self._autoreconnect)
+                          autoreconnect=self._autoreconnect,
+                          timeout=self._connect_timeout,
+                          multiplex=self._multiplex)
+
+    def _retiring(self, conn):
+        """Whether `conn` was used too much or for too long and must be
+        replaced once it's released"""
+        if self._maxusage and conn.usage > self._maxusage:
+            return True
+
+        return bool(self._max_lifetime) and \
+            time.time() - conn.created_at > self._max_lifetime
+
+    def _discard(self, conn):
+        """Close `conn` for good, it won't come back to the pool"""
+        conn._pool = None
+        conn.close()
+
+    def _fill(self):
+        """Open connections until `min_idle` are idle, within `maxconnections`"""
+        if self._multiplex:
+            idle, opened = self._shared_connections, len(self._shared_connections)
+        else:
+            idle, opened = self._idle_connections, self._connections + len(self._idle_connections)
+
+        while len(idle) < self._min_idle and \
+                (not self._maxconnections or opened < self._maxconnections):
+            idle.append(self._create_connection())
+            opened += 1
+
+    def _schedule_maintenance(self):
+        with stack_context.NullContext():
+            self._maintenance = IOLoop.instance().add_timeout(
+                timedelta(seconds=self._maintenance_interval), self._maintain)
+
+    def _maintain(self):
+        """Close the connections idle or open for too long, then open
+        new ones up to `min_idle`, off the request path"""
+        self._maintenance = None
+        if self._closed:
+            return
+
+        now = time.time()
+        if self._multiplex:
+            idle = [conn for conn in self._shared_connections if not conn.in_flight]
+        else:
+            idle = self._idle_connections
 
-    def connection(self, callback=None, retries=0):
+        kept = 0
+        stale = set()
+        # the most recently used connections are the ones kept
+        for conn in sorted(idle, key=lambda conn: conn.last_used, reverse=True):
+            if conn.closed() or self._retiring(conn) or \
+                    (kept >= self._min_idle and self._max_idle_time and
+                     now - conn.last_used > self._max_idle_time):
+                stale.add(conn)
+            else:
+                kept += 1
+
+        if stale:
+            log.debug('%s closing %d stale connections', self, len(stale))
+            if self._multiplex:
+                self._shared_connections = [conn for conn in self._shared_connections
+                                            if conn not in stale]
+            else:
+                self._idle_connections = deque(conn for conn in self._idle_connections
+                                               if conn not in stale)
+            for conn in stale:
+                self._discard(conn)
+
+        self._fill()
+        self._schedule_maintenance()
+
+    def _deliver(self, conn, callback):
+        """Call `callback` with `conn` as soon as it is connected, raising
+        :class:`~mongotor.errors.InterfaceError` if it can't connect
+        """
+        conn.ready(partial(self._on_connection_ready, conn, callback))
+
+    def _on_connection_ready(self, conn, callback, error):
+        if error:
+            raise error
+
+        callback(conn)
+
+    def connection(self, callback=None):
         """Get a connection from pool
 
+        When `maxconnections` is reached the request waits in a FIFO queue
+        and receives the next released connection.
+
         :Parameters:
           - `callback` : method which will be called when connection is ready
 
         """
-        self._condition.acquire()
+        if self._multiplex:
+            return self._shared_connection(callback)
+
+        if self._idle_connections:
+            conn = self._idle_connections.pop()
+        elif self._maxconnections and self._connections >= self._maxconnections:
+            self._wait_for_connection(callback)
+            return
+        else:
+            conn = self._create_connection()
+
+        self._checkout(conn)
+
+        log.debug('%s %s connection retrieved', self, conn)
+        self._deliver(conn, callback)
+
+    def _checkout(self, conn):
+        self._checked_out.add(conn)
+        self._connections += 1
+
+    def _checkin(self, conn):
+        self._checked_out.remove(conn)
+        self._connections -= 1
+
+    def _wait_for_connection(self, callback):
+        if self._max_waiters and len(self._waiters) >= self._max_waiters:
+            raise TooManyConnections('too many requests waiting for a connection')
+
+        log.debug('%s too many connections, waiting, waiters %d', self, len(self._waiters))
+
+        # errors are raised in the caller's stack context, so they are
+        # delivered to whoever asked for the connection
+        waiter = [stack_context.wrap(partial(self._deliver, callback=callback)),
+                  None, stack_context.wrap(_raise)]
+        if self._wait_queue_timeout:
+            waiter[1] = IOLoop.instance().add_timeout(
+                timedelta(seconds=self._wait_queue_timeout),
+                partial(self._waiter_expired, waiter))
+
+        self._waiters.append(waiter)
+
+    def _waiter_expired(self, waiter):
         try:
-            try:
-                conn = self._idle_connections.pop(0)
-            except IndexError:
-                if self._maxconnections and self._connections >= self._maxconnections:
-                    if retries > 10:
-                        raise TooManyConnections()
+            self._waiters.remove(waiter)
+        except ValueError:
+            return  # already served
 
-                    log.warn('{0} too many connections, retries {1}'.format(self, retries))
-                    retry_connection = partial(self.connection, retries=(retries + 1), callback=callback)
-                    IOLoop.instance().add_timeout(timedelta(microseconds=300), retry_connection)
+        raise TooManyConnections('timed out waiting for a connection')
 
-                    return
+    def _serve_waiter(self, conn):
+        """Hand `conn` straight to the oldest waiter, if there is one.
+        The connection stays checked out on behalf of the waiter.
+        """
+        if not self._waiters:
+            return False
 
-                conn = self._create_connection()
+        deliver, timeout, _ = self._waiters.popleft()
+        if timeout:
+            IOLoop.instance().remove_timeout(timeout)
 
-            self._connections += 1
+        log.debug('%s %s connection handed to waiter', self, conn)
+        IOLoop.instance().add_callback(partial(deliver, conn))
+        return True
 
-        finally:
-            self._condition.release()
+    def _shared_connection(self, callback):
+        """Get the least busy multiplexed connection, opening a new one
+        when every connection already carries `max_in_flight` requests.
+        Multiplexed connections are never checked out, so there is nothing
+        to release once the request is done.
+        """
+        conn = None
+        for candidate in self._shared_connections:
+            if self._retiring(candidate):
+                continue  # retiring, waits for its last reply
+            if conn is None or candidate.in_flight < conn.in_flight:
+                conn = candidate
 
-        log.debug('{0} {1} connection retrieved'.format(self, conn))
-        callback(conn)
+        busy = conn is None or (self._max_in_flight and
+                                conn.in_flight >= self._max_in_flight)
+        room = not self._maxconnections or \
+            len(self._shared_connections) < self._maxconnections
 
-    def release(self, conn):
-        if self._maxusage and conn.usage > self._maxusage:
+        if busy and (room or conn is None):
+            conn = self._create_connection()
+            self._shared_connections.append(conn)
+
+        log.debug('%s %s shared connection retrieved', self, conn)
+        self._deliver(conn, callback)
+
+    def _release_shared(self, conn):
+        if conn not in self._shared_connections:
+            return
+
+        if conn.closed() and not self._autoreconnect:
+            log.debug('%s %s shared connection closed', self, conn)
+            self._shared_connections.remove(conn)
+            return
+
+        if self._retiring(conn) and not conn.in_flight:
+            log.debug('%s %s connection max usage or lifetime expired, renewing...',
+                      self, conn)
+            self._shared_connections.remove(conn)
             if not conn.closed():
-                log.debug('{0} {1} connection max usage expired, renewing...'.format(self, conn))
-                self._connections -= 1
                 conn.close()
+
+    def release(self, conn):
+        if conn.multiplexed:
+            return self._release_shared(conn)
+
+        if conn not in self._checked_out:
+            log.debug('%s %s not checked out, called by socket close', self, conn)
             return
 
-        self._condition.acquire()
+        if self._retiring(conn):
+            log.debug('%s %s connection max usage or lifetime expired, renewing...',
+                      self, conn)
+            self._checkin(conn)
+            self._discard(conn)
 
-        if conn in self._idle_connections:
-            log.debug('{0} {1} called by socket close'.format(self, conn))
-            self._condition.release()
+            if self._waiters:
+                conn = self._create_connection()
+                self._checkout(conn)
+                self._serve_waiter(conn)
             return
 
-        try:
-            self._idle_connections.append(conn)
-            self._condition.notify()
-        finally:
-            self._connections -= 1
-            self._condition.release()
+        if self._serve_waiter(conn):
+            return
+
+        self._checkin(conn)
+        self._idle_connections.append(conn)
+
+        log.debug('%s %s release connection', self, conn)
+
+    def connection_lost(self, conn):
+        log.debug('%s %s connection lost', self, conn)
+        if self._on_connection_lost:
+            self._on_connection_lost(conn.last_sent)
 
-        log.debug('{0} {1} release connection'.format(self, conn))
+    def reply_received(self, conn, sent_at):
+        if self._on_reply:
+            self._on_reply(sent_at)
+
+    def not_master(self, conn):
+        if self._on_not_master:
+            self._on_not_master()
 
     def close(self):
         """Close all connections in the pool."""
-        log.debug('{0} closing...'.format(self))
-        self._condition.acquire()
-        try:
-            while self._idle_connections:  # close all idle connections
-                con = self._idle_connections.pop(0)
-                try:
-                    con.close()
-                except Exception:
-                    pass
-                self._connections -= 1
-            self._condition.notifyAll()
-        finally:
-            self._condition.release()
+        log.debug('%s closing...', self)
+        self._closed = True
+        if self._maintenance:
+            IOLoop.instance().remove_timeout(self._maintenance)
+            self._maintenance = None
+
+        while self._waiters:  # fail everyone still waiting
+            _, timeout, fail = self._waiters.popleft()
+            if timeout:
+                IOLoop.instance().remove_timeout(timeout)
+            IOLoop.instance().add_callback(partial(fail, InterfaceError('pool closed')))
+        while self._idle_connections:  # close all idle connections
+            self._discard(self._idle_connections.pop())
+        while self._shared_connections:
+            con = self._shared_connections.pop()
+            try:
+                con.close()
+            except Exception:
+                pass
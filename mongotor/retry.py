@@ -0,0 +1,75 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import random
+import time
+from tornado.ioloop import IOLoop
+from mongotor.errors import InterfaceError, TooManyConnections, NotMasterError
+
+
+class RetryPolicy(object):
+    """When and how soon a failed operation is sent again
+
+    An operation is retried on a fresh connection, on whichever node the
+    read preference selects then, when it failed because:
+
+    * the node was not the primary anymore, the operation was rejected
+      so it's always safe to send it again.
+    * the connection was lost, only for reads and idempotent writes as
+      the operation may have been applied.
+
+    Retries wait a random time up to `backoff` seconds, doubling at each
+    attempt up to `max_backoff`, and are not made once `deadline` seconds
+    have passed since the operation started.
+
+    >>> client = Client(db, 'events', retry_policy=RetryPolicy(retries=1, deadline=2))
+    """
+
+    def __init__(self, retries=1, backoff=0.05, max_backoff=1, deadline=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+
+    def delay(self, attempt):
+        """Seconds to wait before the `attempt` th retry"""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def should_retry(self, error, attempt, started, idempotent=True):
+        """Should an operation started at `started` be retried after
+        failing with `error`, `attempt` retries having been made"""
+        if attempt >= self.retries:
+            return False
+
+        if self.deadline is not None and time.time() - started >= self.deadline:
+            return False
+
+        if isinstance(error, NotMasterError):
+            return True
+
+        if isinstance(error, TooManyConnections):
+            return False
+
+        return idempotent and isinstance(error, InterfaceError)
+
+    def wait(self, attempt, started, callback):
+        """Call `callback` once it's time for the `attempt` th retry, but
+        not past the deadline"""
+        deadline = time.time() + self.delay(attempt)
+        if self.deadline is not None:
+            deadline = min(deadline, started + self.deadline)
+
+        IOLoop.instance().add_timeout(deadline, callback)
@@ -0,0 +1,116 @@
+# coding: utf-8
+from mongotor.breaker import CircuitBreaker
+from tests.util import unittest
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_ratio=0.5, min_requests=4, window=10,
+                                      reset_timeout=5)
+
+    def _fail(self, times):
+        for i in range(times):
+            self.breaker.record_failure()
+
+    def _expire(self):
+        self.breaker._opened_at -= self.breaker.reset_timeout
+
+    def test_closed_by_default(self):
+        """[CircuitBreakerTestCase] - breaker starts closed and allows requests"""
+        self.assertEquals(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_not_open_before_min_requests(self):
+        """[CircuitBreakerTestCase] - breaker needs min_requests outcomes to open"""
+        self._fail(3)
+
+        self.assertEquals(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_open_on_failure_ratio(self):
+        """[CircuitBreakerTestCase] - breaker opens when the failure ratio is reached"""
+        self.breaker.record_success()
+        self.breaker.record_success()
+        self._fail(1)
+        self.assertEquals(self.breaker.state, CircuitBreaker.CLOSED)
+
+        self._fail(1)
+
+        self.assertEquals(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allows_requests())
+        self.assertFalse(self.breaker.allow())
+
+    def test_old_outcomes_leave_the_window(self):
+        """[CircuitBreakerTestCase] - only the last outcomes count"""
+        self._fail(3)
+        for i in range(10):
+            self.breaker.record_success()
+        self._fail(4)
+
+        self.assertEquals(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_allows_a_single_probe(self):
+        """[CircuitBreakerTestCase] - half open breaker lets one probe through"""
+        self._fail(4)
+        self._expire()
+
+        self.assertEquals(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allows_requests())
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allows_requests())
+        self.assertFalse(self.breaker.allow())
+
+    def test_lost_probe_is_replaced(self):
+        """[CircuitBreakerTestCase] - a probe that doesn't report back is replaced"""
+        self._fail(4)
+        self._expire()
+        self.breaker.allow()
+        self.breaker._probe_time -= self.breaker.reset_timeout
+
+        self.assertTrue(self.breaker.allow())
+
+    def test_probe_success_closes(self):
+        """[CircuitBreakerTestCase] - successful probe closes the breaker"""
+        self._fail(4)
+        self._expire()
+        self.breaker.allow()
+        self.breaker.record_success()
+
+        self.assertEquals(self.breaker.state, CircuitBreaker.CLOSED)
+        self._fail(3)
+        self.assertEquals(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_probe_failure_opens_again(self):
+        """[CircuitBreakerTestCase] - failed probe opens the breaker again"""
+        self._fail(4)
+        self._expire()
+        self.breaker.allow()
+        self.breaker.record_failure()
+
+        self.assertEquals(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_late_outcomes_dont_decide_half_open(self):
+        """[CircuitBreakerTestCase] - outcomes of requests sent before the probe are ignored"""
+        self._fail(4)
+        self._expire()
+        self.breaker.allow()
+        sent_at = self.breaker._probe_time - 1
+
+        self.breaker.record_success(sent_at)
+        self.assertEquals(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+        self.breaker.record_failure(sent_at)
+        self.assertEquals(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+        self.breaker.record_success(self.breaker._probe_time)
+        self.assertEquals(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_outcomes_without_probe_dont_decide_half_open(self):
+        """[CircuitBreakerTestCase] - half open breaker waits for the probe outcome"""
+        self._fail(4)
+        self._expire()
+
+        self.breaker.record_success()
+        self.breaker.record_failure()
+
+        self.assertEquals(self.breaker.state, CircuitBreaker.HALF_OPEN)
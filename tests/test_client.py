@@ -3,6 +3,9 @@ import six
 from tornado.ioloop import IOLoop
 from tornado import testing
 from mongotor.database import Database
+from mongotor.client import Client
+from mongotor.errors import IntegrityError, InvalidOperationError, \
+    TooManyConnections
 from bson import ObjectId
 from datetime import datetime
 
@@ -46,6 +49,200 @@ class ClientTestCase(testing.AsyncTestCase):
         self.assertEquals(response['ok'], 1.0)
         self.assertIsNone(error)
 
+    def test_insert_many_documents_from_a_generator(self):
+        """[ClientTestCase] - insert many documents from a generator splitting them in batches"""
+
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test')
+
+        db.get_node(callback=self.stop)
+        node = self.wait()
+        node.max_message_size = 1024
+
+        documents = ({'_id': ObjectId(), 'index': i, 'name': 'x' * 100}
+                     for i in six.moves.range(30))
+
+        db.collection_test.insert_many(documents, callback=self.stop)
+        result, error = self.wait()
+
+        self.assertIsNone(error)
+        self.assertEquals(result['inserted_count'], 30)
+        self.assertTrue(result['batch_count'] > 1)
+
+        db.collection_test.count(callback=self.stop)
+        self.assertEquals(self.wait(), 30)
+
+    def test_insert_many_unordered_continues_after_error(self):
+        """[ClientTestCase] - insert many unordered documents continues after an error"""
+
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test')
+
+        db.get_node(callback=self.stop)
+        node = self.wait()
+        node.max_message_size = 256
+
+        duplicated = {'_id': ObjectId(), 'name': 'x' * 100}
+        documents = [duplicated, dict(duplicated), {'_id': ObjectId(), 'name': 'x' * 100}]
+
+        db.collection_test.insert_many(documents, ordered=False, callback=self.stop)
+        result, error = self.wait()
+
+        self.assertIsInstance(error, IntegrityError)
+        self.assertEquals(result['batch_count'], 3)
+        self.assertEquals(result['inserted_count'], 2)
+
+    def test_insert_many_unordered_in_parallel(self):
+        """[ClientTestCase] - insert many unordered documents over many connections"""
+
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test', maxconnections=4)
+
+        db.get_node(callback=self.stop)
+        node = self.wait()
+        node.max_message_size = 1024
+
+        documents = ({'_id': ObjectId(), 'index': i, 'name': 'x' * 100}
+                     for i in six.moves.range(60))
+
+        db.collection_test.insert_many(documents, ordered=False, concurrency=4,
+                                       callback=self.stop)
+        result, error = self.wait()
+
+        self.assertIsNone(error)
+        self.assertEquals(result['inserted_count'], 60)
+        self.assertEquals(len(result['responses']), result['batch_count'])
+
+        db.collection_test.count(callback=self.stop)
+        self.assertEquals(self.wait(), 60)
+
+    def test_coalesce_concurrent_single_document_inserts(self):
+        """[ClientTestCase] - coalesce concurrent single document inserts into one message"""
+
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test', coalesce_inserts=True)
+
+        responses = []
+
+        def on_insert(response):
+            responses.append(response)
+            if len(responses) == 10:
+                self.stop()
+
+        for i in six.moves.range(10):
+            db.collection_test.insert({'_id': ObjectId(), 'index': i}, callback=on_insert)
+
+        coalescer = db._get_coalescer(db.get_collection_name('collection_test'), True, True)
+        self.assertEquals(len(coalescer._pending), 10)
+
+        self.wait()
+
+        for response, error in responses:
+            self.assertEquals(response['ok'], 1.0)
+            self.assertIsNone(error)
+
+        db.collection_test.count(callback=self.stop)
+        self.assertEquals(self.wait(), 10)
+
+    def test_coalesced_insert_of_a_document_too_large(self):
+        """[ClientTestCase] - a coalesced document too large fails for its caller only"""
+
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test', coalesce_inserts=True)
+
+        db.get_node(callback=self.stop)
+        node = self.wait()
+        node.max_bson_size = 1024
+
+        db.collection_test.insert({'_id': ObjectId(), 'name': 'x' * 2048})
+        db.collection_test.insert({'_id': ObjectId()}, callback=self.stop)
+
+        self.assertRaises(InvalidOperationError, self.wait)
+        response, error = self.wait()
+
+        self.assertEquals(response['ok'], 1.0)
+        self.assertIsNone(error)
+
+    def test_coalesced_insert_with_exhausted_pool(self):
+        """[ClientTestCase] - coalesced inserts fail when no connection is available"""
+
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test', coalesce_inserts=True, maxconnections=1,
+            wait_queue_timeout=0.1)
+
+        db.get_node(callback=self.stop)
+        node = self.wait()
+        node.connection(self.stop)
+        self.wait()  # the only connection is held
+
+        db.collection_test.insert({'_id': ObjectId()}, callback=self.stop)
+
+        self.assertRaises(TooManyConnections, self.wait)
+
+    def test_coalesced_insert_with_shared_error(self):
+        """[ClientTestCase] - an error for a coalesced message is returned to each caller"""
+
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test', coalesce_inserts=True)
+
+        document = {'_id': ObjectId()}
+        db.collection_test.insert(document, coalesce=False, callback=self.stop)
+        self.wait()
+
+        responses = []
+
+        def on_insert(response):
+            responses.append(response)
+            if len(responses) == 2:
+                self.stop()
+
+        db.collection_test.insert(document, callback=on_insert)
+        db.collection_test.insert({'_id': ObjectId()}, callback=on_insert)
+        self.wait()
+
+        for response, error in responses:
+            self.assertIsInstance(error, IntegrityError)
+
+        db.collection_test.count(callback=self.stop)
+        self.assertEquals(self.wait(), 2)
+
+    def test_insert_with_write_concern(self):
+        """[ClientTestCase] - insert a document with a write concern"""
+
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test', write_concern={'w': 1})
+
+        document = {'_id': ObjectId(), 'name': 'shouldbename'}
+
+        db.collection_test.insert(document, write_concern={'w': 1, 'wtimeout': 1000},
+            callback=self.stop)
+        response, error = self.wait()
+
+        self.assertEquals(response['ok'], 1.0)
+        self.assertIsNone(error)
+
+    def test_insert_unacknowledged_with_write_concern_w_0(self):
+        """[ClientTestCase] - insert a document without acknowledgement when w is 0"""
+
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test')
+
+        client = Client(db, 'collection_test', write_concern={'w': 0})
+        client.insert({'_id': ObjectId()}, callback=self.stop)
+        response, error = self.wait()
+
+        self.assertIsNone(response)
+        self.assertIsNone(error)
+
+    def test_raises_error_with_invalid_write_concern(self):
+        """[ClientTestCase] - raises error with an invalid write concern"""
+
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test')
+
+        self.assertRaises(InvalidOperationError, Client, db, 'collection_test',
+                          write_concern={'wtimeoutms': 10})
+
     def test_remove_document_by_id(self):
         """[ClientTestCase] - remove a document by id"""
         db = Database.init(["localhost:27027", "localhost:27028"],
@@ -2,11 +2,16 @@
 from __future__ import with_statement
 from tornado.ioloop import IOLoop
 from tornado import testing
+from tornado import stack_context
 from mongotor.connection import Connection
-from mongotor.errors import InterfaceError, DatabaseError, IntegrityError
+from mongotor.errors import InterfaceError, DatabaseError, IntegrityError, \
+    ProgrammingError
 from bson import ObjectId
 from mongotor import message
 from mongotor import helpers
+from mongotor import events
+from functools import partial
+from tests.util import Listener
 
 import fudge
 
@@ -27,13 +32,33 @@ class ConnectionTestCase(testing.AsyncTestCase):
     def test_not_connect_to_mongo_raises_error(self):
         """[ConnectionTestCase] - Raises error when can't connect to mongo"""
 
-        self.assertRaisesRegexp(InterfaceError, "Connection refused", Connection,
-                                host="localhost", port=27000)
+        conn = Connection(host="localhost", port=27000)
+        conn.ready(self.stop)
+        error = self.wait()
+
+        self.assertIsInstance(error, InterfaceError)
+        self.assertRegexpMatches(str(error), "Connection refused")
+
+    def test_connect_timeout_raises_error(self):
+        """[ConnectionTestCase] - Raises error when connect takes longer than timeout"""
+
+        conn = Connection(host="10.255.255.1", port=27017, timeout=0.1)
+        conn.ready(self.stop)
+        error = self.wait()
+
+        self.assertIsInstance(error, InterfaceError)
+        self.assertRegexpMatches(str(error), "timed out")
+        self.assertTrue(conn.closed())
 
     def test_connect_to_mongo(self):
         """[ConnectionTestCase] - Can stabilish connection to mongo"""
 
+        self.conn.ready(self.stop)
+        error = self.wait()
+
+        self.assertIsNone(error)
         self.assertTrue(self.conn._connected)
+        self.assertFalse(self.conn._connecting)
 
     def test_send_test_message_to_mongo(self):
         """[ConnectionTestCase] - Send message to test driver connection"""
@@ -92,11 +117,79 @@ class ConnectionTestCase(testing.AsyncTestCase):
         """[ConnectionTestCase] - Reconnect to mongo when connection was lost"""
 
         self.conn.close()
-        self.conn._callback = self.stop
+        self.conn._requests[0] = (self.stop, None, None)
         self.wait()
 
         self.test_send_test_message_to_mongo()
 
+    def test_raises_programming_error_when_connection_is_in_use(self):
+        """[ConnectionTestCase] - Raises ProgrammingError when a connection without multiplex is in use"""
+
+        message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+            {'driverOIDTest': ObjectId()})
+
+        self.conn.send_message_with_response(message_test, callback=self.stop)
+
+        self.assertRaisesRegexp(ProgrammingError, "connection already in use",
+                                self.conn.send_message_with_response,
+                                message_test, callback=None)
+        self.wait()
+
+    def test_multiplex_many_requests_in_one_connection(self):
+        """[ConnectionTestCase] - Route many in-flight replies by request id in a multiplexed connection"""
+
+        conn = Connection(host="localhost", port=27027, multiplex=True)
+        object_ids = [ObjectId() for i in range(10)]
+        results = {}
+
+        def on_response(object_id, response):
+            response, error = response
+            results[object_id] = helpers._unpack_response(response)['data'][0]
+            if len(results) == len(object_ids):
+                self.stop()
+
+        for object_id in object_ids:
+            message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+                {'driverOIDTest': object_id})
+            conn.send_message_with_response(message_test,
+                callback=partial(on_response, object_id))
+
+        self.assertEquals(conn.in_flight, 10)
+        self.wait()
+
+        for object_id in object_ids:
+            self.assertEquals(results[object_id]['oid'], object_id)
+        self.assertEquals(conn.in_flight, 0)
+        conn.close()
+
+    def test_multiplex_error_in_one_request_keeps_the_others(self):
+        """[ConnectionTestCase] - An error in one request of a multiplexed connection doesn't fail the others"""
+
+        conn = Connection(host="localhost", port=27027, multiplex=True)
+        errors = []
+
+        def on_error(typ, value, tb):
+            errors.append(value)
+            return True
+
+        def fail(response):
+            raise ValueError('oops')
+
+        with stack_context.ExceptionStackContext(on_error):
+            conn.send_message_with_response(message.query(0, 'mongotor_test.$cmd', 0, 1,
+                {'driverOIDTest': ObjectId()}), callback=fail)
+
+        conn.send_message_with_response(message.query(0, 'mongotor_test.$cmd', 0, 1,
+            {'driverOIDTest': ObjectId()}), callback=self.stop)
+
+        response, error = self.wait()
+
+        self.assertIsNone(error)
+        self.assertIsNotNone(response)
+        self.assertEquals(len(errors), 1)
+        self.assertFalse(conn.closed())
+        conn.close()
+
     def test_raises_interface_error_when_cant_reconnect(self):
         """[ConnectionTestCase] - Raises InterfaceError when connection was lost and autoreconnect is False"""
 
@@ -115,3 +208,79 @@ class ConnectionTestCase(testing.AsyncTestCase):
 
         with fudge.patched_context(self.conn, '_stream', fake_stream):
             self.assertRaises(IOError, self.conn.send_message, (0, ''), callback=None)
+
+    def test_send_message_with_response_publishes_events(self):
+        """[ConnectionTestCase] - Publish started and succeeded events for a message with a reply"""
+
+        listener = Listener()
+        events.register(listener)
+        self.addCleanup(events.unregister, listener)
+
+        request_id, data = message.query(0, 'mongotor_test.$cmd', 0, 1,
+            {'driverOIDTest': ObjectId()})
+
+        self.conn.send_message_with_response((request_id, data), callback=self.stop)
+
+        callback, on_reply, command = self.conn._requests[request_id]
+        self.assertTrue(callable(callback))
+        self.assertTrue(callable(on_reply))
+        self.assertEquals(command.event.request_id, request_id)
+
+        self.wait()
+
+        (name, started), (name2, succeeded) = listener.events
+        self.assertEquals(name, 'started')
+        self.assertEquals(started.operation, 'command')
+        self.assertEquals(started.command_name, 'driverOIDTest')
+        self.assertEquals(started.request_id, request_id)
+        self.assertEquals(started.address, ('localhost', 27027))
+        self.assertEquals(started.message_size, len(data))
+
+        self.assertEquals(name2, 'succeeded')
+        self.assertEquals(succeeded.request_id, request_id)
+        self.assertEquals(succeeded.document_count, 1)
+        self.assertTrue(succeeded.reply_size > 16)
+
+    def test_send_message_publishes_events(self):
+        """[ConnectionTestCase] - Publish events for messages sent with and without getLastError"""
+
+        listener = Listener()
+        events.register(listener)
+        self.addCleanup(events.unregister, listener)
+
+        message_insert = message.insert('mongotor_test.articles', [{'_id': ObjectId()}],
+            False, True, {})
+        self.conn.send_message(message_insert, callback=self.stop)
+        self.wait()
+
+        message_insert = message.insert('mongotor_test.articles', [{'_id': ObjectId()}],
+            False, True, {})
+        self.conn.send_message(message_insert, True, callback=self.stop)
+        self.wait()
+
+        names = [name for name, _ in listener.of('insert')]
+        self.assertEquals(names, ['started', 'succeeded', 'started', 'succeeded'])
+
+        unacknowledged, acknowledged = listener.of('insert')[1][1], listener.of('insert')[3][1]
+        self.assertEquals((unacknowledged.reply_size, unacknowledged.document_count), (0, 0))
+        self.assertEquals(acknowledged.document_count, 1)
+
+    def test_lost_request_publishes_failed_event(self):
+        """[ConnectionTestCase] - Publish a failed event for a request the connection drops"""
+
+        listener = Listener()
+        events.register(listener)
+        self.addCleanup(events.unregister, listener)
+
+        message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+            {'driverOIDTest': ObjectId()})
+        self.conn.send_message_with_response(message_test, callback=self.stop)
+        self.conn.close()
+
+        response, error = self.wait()
+
+        self.assertIsInstance(error, InterfaceError)
+        (name, _), (name2, failed) = listener.events
+        self.assertEquals((name, name2), ('started', 'failed'))
+        self.assertEquals(failed.request_id, message_test[0])
+        self.assertIs(failed.failure, error)
@@ -1,12 +1,20 @@
 # coding: utf-8
 import six
+from concurrent.futures import ThreadPoolExecutor
 from tornado.ioloop import IOLoop
 from tornado import testing
+from tornado.concurrent import Future
+import bson
 from bson.objectid import ObjectId
 from mongotor import message
+from mongotor import helpers
+from mongotor import events
 from mongotor.cursor import Cursor, DESCENDING, ASCENDING
 from mongotor.database import Database
 from mongotor.node import ReadPreference
+from mongotor.errors import InterfaceError
+from mongotor.retry import RetryPolicy
+from tests.util import Listener
 
 
 class CursorTestCase(testing.AsyncTestCase):
@@ -202,3 +210,311 @@ class CursorTestCase(testing.AsyncTestCase):
         self.assertEquals(len(result['comment']), 1)
         self.assertEquals(result['comment'][0]['author'], 'joe')
         self.assertIsNone(_)
+
+    def test_find_documents_in_batches(self):
+        """[CursorTestCase] - Find all documents fetching them in batches"""
+
+        documents = [{'_id': ObjectId(), 'index': i} for i in six.moves.range(7)]
+        for document in documents:
+            self._insert_document(document)
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'index': ASCENDING},
+            batch_size=2)
+        cursor.find(callback=self.stop)
+
+        result, error = self.wait()
+
+        self.assertEquals([doc['index'] for doc in result], list(six.moves.range(7)))
+        self.assertFalse(cursor.alive)
+        self.assertIsNone(error)
+
+    def test_fetch_next_streams_documents(self):
+        """[CursorTestCase] - Stream documents with fetch_next"""
+
+        documents = [{'_id': ObjectId(), 'index': i} for i in six.moves.range(5)]
+        for document in documents:
+            self._insert_document(document)
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'index': ASCENDING},
+            batch_size=2)
+
+        found = []
+        while True:
+            cursor.fetch_next(callback=self.stop)
+            if not self.wait():
+                break
+            found.append(cursor.next_object()['index'])
+
+        self.assertEquals(found, list(six.moves.range(5)))
+        self.assertFalse(cursor.alive)
+
+    def test_fetch_next_closes_cursor_on_error(self):
+        """[CursorTestCase] - Close the server cursor when a batch can't be fetched"""
+
+        for i in six.moves.range(5):
+            self._insert_document({'_id': ObjectId(), 'index': i})
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'index': ASCENDING},
+            batch_size=2)
+        cursor.fetch_next(callback=self.stop)
+        self.assertTrue(self.wait())
+        self.assertTrue(cursor._cursor_id)
+
+        def fail(message_query, retryable=False):
+            future = Future()
+            future.set_exception(InterfaceError('connection closed'))
+            return future
+
+        cursor._send_request = fail
+        cursor.next_object()
+        cursor.next_object()
+
+        cursor.fetch_next(callback=self.stop)
+        self.assertRaises(InterfaceError, self.wait)
+        self.assertEquals(cursor._cursor_id, 0)
+        self.assertFalse(cursor.alive)
+
+    def test_find_documents_with_limit_and_batch_size(self):
+        """[CursorTestCase] - Find documents with limit bigger than batch size"""
+
+        for i in six.moves.range(5):
+            self._insert_document({'_id': ObjectId(), 'index': i})
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'index': ASCENDING},
+            limit=3, batch_size=2)
+        cursor.find(callback=self.stop)
+
+        result, error = self.wait()
+
+        self.assertEquals([doc['index'] for doc in result], [0, 1, 2])
+        self.assertIsNone(error)
+
+    def test_fetch_next_prefetching_batches(self):
+        """[CursorTestCase] - Stream documents prefetching the next batch"""
+
+        for i in six.moves.range(6):
+            self._insert_document({'_id': ObjectId(), 'index': i})
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'index': ASCENDING},
+            batch_size=2, prefetch=1)
+
+        cursor.fetch_next(callback=self.stop)
+        self.assertTrue(self.wait())
+        self.assertEquals(len(cursor._in_flight), 1)
+
+        found = [cursor.next_object()['index']]
+        while True:
+            cursor.fetch_next(callback=self.stop)
+            if not self.wait():
+                break
+            found.append(cursor.next_object()['index'])
+
+        self.assertEquals(found, list(six.moves.range(6)))
+
+    def test_prefetch_next_batch_before_decoding(self):
+        """[CursorTestCase] - Request the next batch before decoding the current one"""
+
+        for i in six.moves.range(5):
+            self._insert_document({'_id': ObjectId(), 'index': i})
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'index': ASCENDING},
+            batch_size=2, prefetch=1)
+
+        in_flight = []
+        unpack_response = cursor._unpack_response
+
+        def record_in_flight(response, cursor_id):
+            in_flight.append(len(cursor._in_flight))
+            return unpack_response(response, cursor_id)
+
+        cursor._unpack_response = record_in_flight
+        cursor.find(callback=self.stop)
+
+        result, error = self.wait()
+
+        self.assertEquals([doc['index'] for doc in result], list(six.moves.range(5)))
+        self.assertEquals(in_flight, [1, 1, 0])
+
+    def test_find_raw_documents(self):
+        """[CursorTestCase] - Find documents without decoding them"""
+
+        document = {'_id': ObjectId(), 'name': 'should be name'}
+        self._insert_document(document)
+
+        cursor = Cursor(Database(), 'cursor_test', raw=True)
+        cursor.find(callback=self.stop)
+
+        result, error = self.wait()
+
+        self.assertEquals(len(result), 1)
+        self.assertEquals(result[0].raw, bson.BSON.encode(document))
+        self.assertEquals(result[0]['name'], document['name'])
+        self.assertIsNone(error)
+
+    def test_find_decoding_in_executor(self):
+        """[CursorTestCase] - Find documents decoding large batches in an executor"""
+
+        for i in six.moves.range(5):
+            self._insert_document({'_id': ObjectId(), 'index': i})
+
+        executor = ThreadPoolExecutor(1)
+        Database()._decode_executor = executor
+        Database()._decode_threshold = 0
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'index': ASCENDING},
+            batch_size=2)
+        cursor.find(callback=self.stop)
+
+        result, error = self.wait()
+
+        self.assertEquals([doc['index'] for doc in result], list(six.moves.range(5)))
+        self.assertIsNone(error)
+        executor.shutdown()
+
+    def test_find_hedged(self):
+        """[CursorTestCase] - Find documents hedging the query to a second node"""
+
+        for i in six.moves.range(3):
+            self._insert_document({'_id': ObjectId(), 'index': i})
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'index': ASCENDING},
+            batch_size=2, read_preference=ReadPreference.NEAREST, hedge=True,
+            hedge_delay=0)
+
+        asked = []
+        send_to_node = cursor._send_to_node
+
+        def record_node(node, message_query):
+            asked.append(node)
+            return send_to_node(node, message_query)
+
+        found = []
+        discarded = []
+        discard_reply = cursor._discard_reply
+
+        def record_discard(node, connection, response):
+            discarded.append((node, helpers._reply_cursor_id(response)))
+            discard_reply(node, connection, response)
+            if found:
+                self.stop()
+
+        cursor._send_to_node = record_node
+        cursor._discard_reply = record_discard
+        cursor.find(callback=self.stop)
+
+        result, error = self.wait()
+        found.append(result)
+
+        self.assertEquals([doc['index'] for doc in result], [0, 1, 2])
+        self.assertIsNone(error)
+        self.assertEquals(len(asked), 2)
+        self.assertNotEquals(asked[0], asked[1])
+
+        if not discarded:
+            self.wait()  # the other node hasn't replied yet
+
+        loser, cursor_id = discarded[0]
+        self.assertIn(loser, asked)
+        self.assertIsNot(loser, cursor._node)
+        self.assertTrue(cursor_id)
+
+    def test_find_hedged_when_first_node_fails(self):
+        """[CursorTestCase] - Hedge the query right away when the first node fails"""
+
+        self._insert_document({'_id': ObjectId(), 'index': 0})
+
+        cursor = Cursor(Database(), 'cursor_test',
+            read_preference=ReadPreference.NEAREST, hedge=True, hedge_delay=10)
+
+        asked = []
+        send_to_node = cursor._send_to_node
+
+        def fail_first(node, message_query):
+            asked.append(node)
+            if len(asked) == 1:
+                future = Future()
+                future.set_exception(InterfaceError('connection closed'))
+                return future
+            return send_to_node(node, message_query)
+
+        cursor._send_to_node = fail_first
+        cursor.find(callback=self.stop)
+
+        result, error = self.wait()
+
+        self.assertEquals([doc['index'] for doc in result], [0])
+        self.assertIsNone(error)
+        self.assertEquals(len(asked), 2)
+        self.assertIs(cursor._node, asked[1])
+
+    def test_find_publishes_one_command_across_get_mores(self):
+        """[CursorTestCase] - Publish a single find command for a query and its getMores"""
+
+        for i in six.moves.range(5):
+            self._insert_document({'_id': ObjectId(), 'index': i})
+
+        listener = Listener()
+        events.register(listener)
+        self.addCleanup(events.unregister, listener)
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'index': ASCENDING},
+            batch_size=2)
+        cursor.find(callback=self.stop)
+        result, error = self.wait()
+
+        self.assertEquals(len(result), 5)
+        (name, started), (name2, succeeded) = listener.of('find')
+        self.assertEquals((name, name2), ('started', 'succeeded'))
+        self.assertEquals(started.namespace, 'mongotor_test.cursor_test')
+        self.assertEquals(succeeded.document_count, 5)
+        self.assertEquals(succeeded.address, (cursor._node.host, cursor._node.port))
+
+        get_mores = [event for name, event in listener.of('get_more') if name == 'started']
+        self.assertEquals(len(get_mores), 2)
+
+    def test_find_publishes_one_command_across_retries(self):
+        """[CursorTestCase] - Publish a single find command for a retried query"""
+
+        self._insert_document({'_id': ObjectId(), 'index': 0})
+
+        listener = Listener()
+        events.register(listener)
+        self.addCleanup(events.unregister, listener)
+
+        cursor = Cursor(Database(), 'cursor_test', retry_policy=RetryPolicy(retries=1))
+        get_connection = cursor._get_connection
+        attempts = []
+
+        def fail_first(callback):
+            attempts.append(True)
+            if len(attempts) == 1:
+                raise InterfaceError('connection closed')
+            get_connection(callback)
+
+        cursor._get_connection = fail_first
+        cursor.find(callback=self.stop)
+        result, error = self.wait()
+
+        self.assertEquals(len(result), 1)
+        self.assertEquals(len(attempts), 2)
+        self.assertEquals([name for name, _ in listener.of('find')], ['started', 'succeeded'])
+
+    def test_find_hedged_publishes_one_command(self):
+        """[CursorTestCase] - Publish a single find command for a hedged query"""
+
+        self._insert_document({'_id': ObjectId(), 'index': 0})
+
+        listener = Listener()
+        events.register(listener)
+        self.addCleanup(events.unregister, listener)
+
+        cursor = Cursor(Database(), 'cursor_test',
+            read_preference=ReadPreference.NEAREST, hedge=True, hedge_delay=0)
+        cursor.find(callback=self.stop)
+        result, error = self.wait()
+
+        self.assertEquals(len(result), 1)
+        self.assertEquals([name for name, _ in listener.of('find')], ['started', 'succeeded'])
+
+        queries = [event for name, event in listener.of('query') if name == 'started']
+        self.assertEquals(len(set(event.address for event in queries)), 2)
@@ -37,6 +37,24 @@ class DatabaseTestCase(testing.AsyncTestCase):
 
         self.assertEquals(database1, database2)
 
+    def test_parse_addresses(self):
+        """[DatabaseTestCase] - Parse IPv6 addresses and skip invalid ones reported by members"""
+
+        database = Database.init("localhost:27027", dbname='test')
+        addresses = database._parse_addresses(["localhost:27027", "[::1]:27028",
+                                               "localhost", "[::1]", "host:port"],
+                                              skip_invalid=True)
+
+        self.assertEquals(addresses, [('localhost', 27027), ('::1', 27028)])
+
+    def test_init_with_invalid_address_raises_error(self):
+        """[DatabaseTestCase] - Raises ValueError when an address given to init is invalid"""
+
+        self.assertRaises(ValueError, Database.init, "localhost", dbname='test')
+        self.assertRaises(ValueError, Database.init, ["localhost:27027", "[::1]"],
+                          dbname='test')
+        self.assertRaises(ValueError, Database.init, [], dbname='test')
+
     def test_send_test_message(self):
         """[DatabaseTestCase] - Send a test message to database"""
 
@@ -87,3 +105,29 @@ class DatabaseTestCase(testing.AsyncTestCase):
 
         response, error = self.wait()
         self.assertTrue(response['ok'])
+
+    def test_discover_replica_set_members(self):
+        """[DatabaseTestCase] - Discover replica set members from a seed"""
+        database = Database.init("localhost:27027", dbname='test')
+        seed = database._nodes[0]
+
+        database._update_topology(seed, {'setName': 'mongotor', 'ismaster': True,
+            'hosts': ['localhost:27027', 'localhost:27028'],
+            'arbiters': ['localhost:27029']})
+
+        self.assertEquals([(node.host, node.port) for node in database._nodes],
+            [('localhost', 27027), ('localhost', 27028)])
+
+    def test_remove_members_the_primary_does_not_list(self):
+        """[DatabaseTestCase] - Remove members the primary does not list anymore"""
+        database = Database.init(["localhost:27027", "localhost:27028"], dbname='test')
+        seed = database._nodes[0]
+
+        database._update_topology(seed, {'setName': 'mongotor', 'ismaster': False,
+            'secondary': True, 'hosts': ['localhost:27027']})
+        self.assertEquals(len(database._nodes), 2)
+
+        database._update_topology(seed, {'setName': 'mongotor', 'ismaster': True,
+            'hosts': ['localhost:27027']})
+        self.assertEquals([(node.host, node.port) for node in database._nodes],
+            [('localhost', 27027)])
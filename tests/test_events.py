@@ -0,0 +1,90 @@
+# coding: utf-8
+from bson import SON
+from mongotor import events
+from mongotor import message
+from tests.util import unittest, Listener
+
+
+class EventsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = Listener()
+        events.register(self.listener)
+
+    def tearDown(self):
+        events.unregister(self.listener)
+
+    def test_nothing_published_without_listeners(self):
+        """[EventsTestCase] - messages are not inspected without listeners"""
+        events.unregister(self.listener)
+        try:
+            command = events._start_message(message.get_more('test.coll', 10, 1),
+                                            ('localhost', 27027))
+            self.assertIsNone(command)
+        finally:
+            events.register(self.listener)
+
+    def test_write_with_last_error(self):
+        """[EventsTestCase] - acknowledged write is reported with its operation and size"""
+        request_id, data = message.insert('test.coll', [{'a': 1}], True, True, {})
+
+        command = events._start_message((request_id, data), ('localhost', 27027))
+        command.succeeded(65, 1)
+
+        (name, started), (name2, succeeded) = self.listener.events
+        self.assertEquals(name, 'started')
+        self.assertEquals(started.operation, 'insert')
+        self.assertEquals(started.namespace, 'test.coll')
+        self.assertEquals(started.request_id, request_id)
+        self.assertEquals(started.address, ('localhost', 27027))
+        self.assertEquals(started.message_size, len(data))
+
+        self.assertEquals(name2, 'succeeded')
+        self.assertEquals(succeeded.operation, 'insert')
+        self.assertEquals(succeeded.reply_size, 65)
+        self.assertEquals(succeeded.document_count, 1)
+        self.assertTrue(succeeded.duration >= 0)
+
+    def test_command_name(self):
+        """[EventsTestCase] - queries on $cmd are reported as commands"""
+        events._start_message(message.query(0, 'test.$cmd', 0, -1, SON([('count', 'coll')])),
+                              ('localhost', 27027))
+
+        _, started = self.listener.events[0]
+        self.assertEquals(started.operation, 'command')
+        self.assertEquals(started.command_name, 'count')
+        self.assertEquals(started.namespace, 'test.$cmd')
+
+    def test_kill_cursors_has_no_namespace(self):
+        """[EventsTestCase] - killCursors is reported without a namespace"""
+        events._start_message(message.kill_cursors([1]), ('localhost', 27027))
+
+        _, started = self.listener.events[0]
+        self.assertEquals(started.operation, 'kill_cursors')
+        self.assertIsNone(started.namespace)
+
+    def test_failure(self):
+        """[EventsTestCase] - failed operation is reported with its error"""
+        error = Exception('connection closed')
+        command = events._start('find', 'test.coll', 1, None, 10)
+        command.failed(error, ('localhost', 27027))
+
+        _, failed = self.listener.events[1]
+        self.assertEquals(failed.operation, 'find')
+        self.assertEquals(failed.failure, error)
+        self.assertEquals(failed.address, ('localhost', 27027))
+
+    def test_listener_errors_are_ignored(self):
+        """[EventsTestCase] - errors raised by listeners don't reach the driver"""
+        class Broken(events.CommandListener):
+            def started(self, event):
+                raise ValueError('oops')
+
+        broken = Broken()
+        events.register(broken)
+        try:
+            events._start('find', 'test.coll', 1, None, 10)
+        finally:
+            events.unregister(broken)
+
+        self.assertEquals(len(self.listener.events), 1)
@@ -0,0 +1,96 @@
+# coding: utf-8
+import struct
+import bson
+from mongotor import helpers
+from mongotor.errors import DatabaseError, InterfaceError, NotMasterError, \
+    InvalidOperationError
+from tests.util import unittest
+
+
+def _reply(documents, flags=0, cursor_id=0, starting_from=0):
+    data = b"".join(bson.BSON.encode(document) for document in documents)
+    return struct.pack("<iqii", flags, cursor_id, starting_from,
+                       len(documents)) + data
+
+
+class HelpersTestCase(unittest.TestCase):
+
+    def test_unpack_response(self):
+        """[HelpersTestCase] - unpack response fields and documents"""
+        documents = [{'index': i} for i in range(3)]
+
+        result = helpers._unpack_response(_reply(documents, cursor_id=1234,
+                                                 starting_from=10))
+
+        self.assertEquals(result['cursor_id'], 1234)
+        self.assertEquals(result['starting_from'], 10)
+        self.assertEquals(result['number_returned'], 3)
+        self.assertEquals(result['data'], documents)
+
+    def test_reply_fields_without_decoding(self):
+        """[HelpersTestCase] - read reply cursor id and document count without decoding"""
+        response = _reply([{'index': i} for i in range(3)], cursor_id=1234)
+
+        self.assertEquals(helpers._reply_cursor_id(response), 1234)
+        self.assertEquals(helpers._reply_number_returned(response), 3)
+
+    def test_unpack_response_from_buffer(self):
+        """[HelpersTestCase] - unpack response from a buffer"""
+        documents = [{'index': i} for i in range(3)]
+
+        result = helpers._unpack_response(bytearray(_reply(documents)))
+
+        self.assertEquals(result['data'], documents)
+
+    def test_unpack_response_with_query_failure(self):
+        """[HelpersTestCase] - unpack response raises the query failure"""
+        response = _reply([{'$err': 'should be error'}], flags=2)
+
+        self.assertRaises(DatabaseError, helpers._unpack_response, response)
+
+    def test_unpack_response_with_not_master(self):
+        """[HelpersTestCase] - unpack response raises NotMasterError when node is not master"""
+        response = _reply([{'$err': 'not master and slaveOk=false', 'code': 13435}],
+                          flags=2)
+
+        self.assertRaises(NotMasterError, helpers._unpack_response, response)
+
+    def test_unpack_response_with_cursor_not_found(self):
+        """[HelpersTestCase] - unpack response raises when cursor is not found"""
+        response = _reply([], flags=1)
+
+        self.assertRaises(InterfaceError, helpers._unpack_response, response,
+                          cursor_id=1234)
+
+    def test_unpack_response_as_raw_documents(self):
+        """[HelpersTestCase] - unpack response as raw documents"""
+        if helpers.RawBSONDocument is None:
+            self.skipTest("raw documents need PyMongo 3.2 or newer")
+
+        documents = [{'index': i} for i in range(3)]
+
+        result = helpers._unpack_response(_reply(documents),
+                                          as_class=helpers.RawBSONDocument)
+
+        for index, document in enumerate(result['data']):
+            self.assertTrue(isinstance(document, helpers.RawBSONDocument))
+            self.assertEquals(document.raw, bson.BSON.encode({'index': index}))
+            self.assertEquals(document['index'], index)
+
+    def test_validate_tag_sets(self):
+        """[HelpersTestCase] - validate tag sets accepts a dict or a list of dicts"""
+        self.assertEquals(helpers._validate_tag_sets({'dc': 'east'}), [{'dc': 'east'}])
+        self.assertEquals(helpers._validate_tag_sets([{'dc': 'east'}, {}]),
+                          [{'dc': 'east'}, {}])
+        self.assertIsNone(helpers._validate_tag_sets(None))
+        self.assertRaises(TypeError, helpers._validate_tag_sets, 'dc:east')
+        self.assertRaises(TypeError, helpers._validate_tag_sets, ['dc:east'])
+
+    def test_validate_max_staleness(self):
+        """[HelpersTestCase] - validate max staleness is at least 90 seconds and a heartbeat plus the idle write period"""
+        self.assertIsNone(helpers._validate_max_staleness(None, 10))
+        self.assertEquals(helpers._validate_max_staleness(90, 10), 90)
+        self.assertEquals(helpers._validate_max_staleness(130, 120), 130)
+        self.assertRaises(InvalidOperationError, helpers._validate_max_staleness, 30, 10)
+        self.assertRaises(InvalidOperationError, helpers._validate_max_staleness, 100, 120)
+        self.assertRaises(TypeError, helpers._validate_max_staleness, '90', 10)
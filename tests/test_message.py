@@ -0,0 +1,56 @@
+# coding: utf-8
+import struct
+import six
+import bson
+from mongotor import message
+from mongotor.errors import InvalidOperationError
+from tests.util import unittest
+
+
+class MessageTestCase(unittest.TestCase):
+
+    def _documents_in(self, insert_message):
+        _, data = insert_message
+        length = struct.unpack("<i", data[:4])[0]
+        data = data[:length]
+        collection_end = data.index(b"\x00", 20) + 1
+        return bson.decode_all(data[collection_end:])
+
+    def test_insert_batches_keeps_all_documents_in_order(self):
+        """[MessageTestCase] - insert batches keeps all documents in order"""
+        documents = ({'index': i, 'name': 'x' * 100} for i in six.moves.range(50))
+
+        batches = list(message.insert_batches('test.collection', documents, True,
+                                              False, {}, False, 16 * 1024 * 1024, 1024))
+
+        found = []
+        for insert_message, count in batches:
+            self.assertTrue(len(insert_message[1]) <= 1024)
+            docs = self._documents_in(insert_message)
+            self.assertEquals(len(docs), count)
+            found.extend(doc['index'] for doc in docs)
+
+        self.assertTrue(len(batches) > 1)
+        self.assertEquals(found, list(six.moves.range(50)))
+
+    def test_insert_batches_sets_continue_on_error(self):
+        """[MessageTestCase] - insert batches sets continue on error flag when unordered"""
+        (insert_message, count), = message.insert_batches(
+            'test.collection', [{'a': 1}], True, False, {}, True,
+            16 * 1024 * 1024, 48 * 1024 * 1024)
+
+        self.assertEquals(struct.unpack("<i", insert_message[1][16:20])[0], 1)
+
+    def test_insert_batches_raises_when_document_is_too_large(self):
+        """[MessageTestCase] - insert batches raises InvalidOperationError when a document is too large"""
+        batches = message.insert_batches('test.collection', [{'name': 'x' * 200}],
+                                         True, False, {}, False, 100, 1024)
+
+        self.assertRaises(InvalidOperationError, list, batches)
+
+    def test_insert_batches_raises_when_there_is_no_document(self):
+        """[MessageTestCase] - insert batches raises InvalidOperationError without documents"""
+        batches = message.insert_batches('test.collection', iter([]), True,
+                                         False, {}, False, 100, 1024)
+
+        self.assertRaises(InvalidOperationError, list, batches)
@@ -1,6 +1,9 @@
 # coding:utf-8
 import unittest
+from datetime import datetime
 from mongotor.node import ReadPreference, Node
+from mongotor.breaker import CircuitBreaker
+from mongotor.monitor import NodeMonitor
 
 
 class ReadPreferenceTestCase(unittest.TestCase):
@@ -74,3 +77,268 @@ class ReadPreferenceTestCase(unittest.TestCase):
             self.secondary2, self.primary], ReadPreference.SECONDARY_PREFERRED)
 
         self.assertEquals(node_found, self.primary)
+
+    def test_read_preference_nearest(self):
+        """[ReadPreferenceTestCase] - get any available node when preference is NEAREST"""
+
+        node_found = ReadPreference.select_node([self.secondary1,
+            self.secondary2, self.primary], ReadPreference.NEAREST)
+
+        self.assertIn(node_found, [self.primary, self.secondary1])
+
+    def test_read_preference_skips_arbiters(self):
+        """[ReadPreferenceTestCase] - never select an arbiter or a recovering member for reads"""
+
+        arbiter = Node(host='localhost', port=27030, database=self.primary.database)
+        arbiter._update({'ismaster': False, 'secondary': False, 'arbiterOnly': True}, 0.001)
+        self.assertTrue(arbiter.available)
+
+        for i in range(20):
+            node_found = ReadPreference.select_node([arbiter, self.secondary1,
+                self.primary], ReadPreference.NEAREST)
+
+            self.assertIn(node_found, [self.primary, self.secondary1])
+
+        self.secondary1.available = False
+        node_found = ReadPreference.select_node([arbiter, self.secondary1,
+            self.primary], ReadPreference.SECONDARY)
+
+        self.assertIsNone(node_found)
+
+    def test_read_preference_nearest_in_latency_window(self):
+        """[ReadPreferenceTestCase] - get node within latency window when preference is NEAREST"""
+
+        self.primary.round_trip_time = 0.100
+        self.secondary1.round_trip_time = 0.002
+
+        for i in range(20):
+            node_found = ReadPreference.select_node([self.secondary1,
+                self.secondary2, self.primary], ReadPreference.NEAREST)
+
+            self.assertEquals(node_found, self.secondary1)
+
+    def test_read_preference_skips_open_circuit(self):
+        """[ReadPreferenceTestCase] - nodes whose circuit breaker is open are not selected"""
+        self.secondary1.breaker = CircuitBreaker(min_requests=1)
+        self.secondary1.breaker.record_failure()
+
+        nodes = [self.primary, self.secondary1, self.secondary2]
+        self.assertIsNone(ReadPreference.select_node(nodes, mode=ReadPreference.SECONDARY))
+        self.assertEquals(ReadPreference.select_node(nodes, ReadPreference.SECONDARY_PREFERRED),
+                          self.primary)
+
+    def test_latency_window(self):
+        """[ReadPreferenceTestCase] - latency window keeps nodes close to the fastest one"""
+
+        self.primary.round_trip_time = 0.020
+        self.secondary1.round_trip_time = 0.010
+        self.secondary2.round_trip_time = 0.030
+
+        nodes = ReadPreference.latency_window([self.primary, self.secondary1,
+            self.secondary2], local_threshold_ms=15)
+
+        self.assertEquals(nodes, [self.primary, self.secondary1])
+
+    def test_latency_window_disabled(self):
+        """[ReadPreferenceTestCase] - latency window without threshold keeps all nodes"""
+
+        self.primary.round_trip_time = 0.500
+        self.secondary1.round_trip_time = 0.010
+
+        nodes = ReadPreference.latency_window([self.primary, self.secondary1],
+            local_threshold_ms=None)
+
+        self.assertEquals(nodes, [self.primary, self.secondary1])
+
+    def test_read_preference_least_outstanding(self):
+        """[ReadPreferenceTestCase] - get least busy secondary when balancing by outstanding requests"""
+
+        self.secondary2.available = True
+        self.secondary2.is_secondary = True
+        self.secondary1.pool._connections = 5
+        self.secondary2.pool._connections = 1
+
+        for i in range(20):
+            node_found = ReadPreference.select_node([self.secondary1,
+                self.secondary2, self.primary], ReadPreference.SECONDARY,
+                balancing=ReadPreference.LEAST_OUTSTANDING)
+
+            self.assertEquals(node_found, self.secondary2)
+
+    def test_read_preference_least_outstanding_weighted_by_rtt(self):
+        """[ReadPreferenceTestCase] - get secondary with lowest outstanding requests times round trip time"""
+
+        self.secondary2.available = True
+        self.secondary2.is_secondary = True
+        self.secondary1.round_trip_time = 0.002
+        self.secondary2.round_trip_time = 0.010
+        self.secondary1.pool._connections = 3
+        self.secondary2.pool._connections = 1
+
+        node_found = ReadPreference.select_node([self.secondary1,
+            self.secondary2, self.primary], ReadPreference.SECONDARY,
+            balancing=ReadPreference.LEAST_OUTSTANDING_RTT)
+
+        self.assertEquals(node_found, self.secondary1)
+
+    def test_read_preference_tag_sets(self):
+        """[ReadPreferenceTestCase] - get secondary matching the first tag set that matches"""
+
+        self.secondary2.available = True
+        self.secondary2.is_secondary = True
+        self.secondary1.tags = {'dc': 'east', 'use': 'serving'}
+        self.secondary2.tags = {'dc': 'east', 'use': 'reporting'}
+
+        for i in range(20):
+            node_found = ReadPreference.select_node([self.secondary1,
+                self.secondary2, self.primary], ReadPreference.SECONDARY,
+                tag_sets=[{'dc': 'west'}, {'dc': 'east', 'use': 'reporting'}, {}])
+
+            self.assertEquals(node_found, self.secondary2)
+
+    def test_read_preference_tag_sets_not_matching(self):
+        """[ReadPreferenceTestCase] - get no secondary when no tag set matches"""
+
+        self.secondary1.tags = {'dc': 'east'}
+
+        node_found = ReadPreference.select_node([self.secondary1,
+            self.secondary2, self.primary], ReadPreference.SECONDARY,
+            tag_sets=[{'dc': 'west'}])
+
+        self.assertIsNone(node_found)
+
+    def test_read_preference_max_staleness(self):
+        """[ReadPreferenceTestCase] - skip secondaries lagging behind the primary"""
+
+        self.secondary2.available = True
+        self.secondary2.is_secondary = True
+        for node in (self.primary, self.secondary1, self.secondary2):
+            node.last_update_time = 1000.0
+        self.primary.last_write_time = 1000.0
+        self.secondary1.last_write_time = 900.0
+        self.secondary2.last_write_time = 995.0
+
+        for i in range(20):
+            node_found = ReadPreference.select_node([self.secondary1,
+                self.secondary2, self.primary], ReadPreference.SECONDARY,
+                max_staleness_seconds=90)
+
+            self.assertEquals(node_found, self.secondary2)
+
+    def test_staleness_without_primary(self):
+        """[ReadPreferenceTestCase] - estimate staleness from the freshest secondary without primary"""
+
+        self.secondary1.last_write_time = 900.0
+        self.secondary2.last_write_time = 1000.0
+
+        staleness = ReadPreference.staleness(self.secondary1, None, self.secondary2)
+
+        self.assertEquals(staleness, 100 + self.secondary1.heartbeat_interval)
+
+
+class NodeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        checks = self.topology_checks = []
+
+        class Database:
+            dbname = 'test'
+
+            @classmethod
+            def _request_topology_check(cls):
+                checks.append(True)
+
+        self.node = Node(host='localhost', port=27027, database=Database)
+
+    def test_update_from_ismaster(self):
+        """[NodeTestCase] - update node state from ismaster reply"""
+        self.node._update({'ismaster': False, 'secondary': True,
+                           'maxBsonObjectSize': 1024}, 0.01)
+
+        self.assertTrue(self.node.available)
+        self.assertTrue(self.node.initialized)
+        self.assertTrue(self.node.is_secondary)
+        self.assertFalse(self.node.is_primary)
+        self.assertEquals(self.node.max_bson_size, 1024)
+        self.assertEquals(self.node.max_message_size, 2048)
+        self.assertEquals(self.node.round_trip_time, 0.01)
+
+    def test_round_trip_time_moving_average(self):
+        """[NodeTestCase] - round trip time is a moving average of samples"""
+        self.node._update({'ismaster': True}, 0.01)
+        self.node._update({'ismaster': True}, 0.11)
+
+        self.assertAlmostEqual(self.node.round_trip_time, 0.03)
+
+    def test_mark_unavailable_resets_round_trip_time(self):
+        """[NodeTestCase] - unavailable node has no round trip time"""
+        self.node._update({'ismaster': True}, 0.01)
+        self.node._mark_unavailable()
+
+        self.assertFalse(self.node.available)
+        self.assertIsNone(self.node.round_trip_time)
+
+    def test_not_master_invalidates_primary(self):
+        """[NodeTestCase] - not master error invalidates the primary and checks the topology"""
+        self.node._update({'ismaster': True}, 0.01)
+        self.node._on_not_master()
+
+        self.assertFalse(self.node.is_primary)
+        self.assertEquals(self.topology_checks, [True])
+
+    def test_lost_connection_to_primary_checks_topology(self):
+        """[NodeTestCase] - lost connection to the primary checks the topology"""
+        self.node._update({'ismaster': True}, 0.01)
+        self.node._on_connection_lost()
+
+        self.assertFalse(self.node.is_primary)
+        self.assertEquals(self.topology_checks, [True])
+
+    def test_update_tags_and_last_write(self):
+        """[NodeTestCase] - update node tags and last write time from ismaster reply"""
+        self.node._update({'ismaster': False, 'secondary': True,
+                           'tags': {'dc': 'east'},
+                           'lastWrite': {'lastWriteDate': datetime(2017, 1, 1, 0, 0, 1)}},
+                          0.01)
+
+        self.assertEquals(self.node.tags, {'dc': 'east'})
+        self.assertEquals(self.node.last_write_time, 1483228801)
+        self.assertIsNotNone(self.node.last_update_time)
+
+    def test_circuit_breaker_counts_replies_and_lost_connections(self):
+        """[NodeTestCase] - replies and lost connections feed the circuit breaker"""
+        node = Node(host='localhost', port=27027, database=self.node.database,
+                    circuit_breaker={'failure_ratio': 0.6, 'min_requests': 2})
+        node._update({'ismaster': False, 'secondary': True}, 0.01)
+
+        node._on_reply()
+        node._on_connection_lost()
+        self.assertTrue(node.selectable)
+
+        node._on_connection_lost()
+        self.assertFalse(node.selectable)
+        self.assertFalse(node._allow_request())
+
+
+class NodeMonitorTestCase(unittest.TestCase):
+
+    def test_check_finishes_when_connection_fails(self):
+        """[NodeMonitorTestCase] - a check that can't open a connection still finishes"""
+
+        class Database:
+            dbname = 'test'
+
+        node = Node(host='localhost', port=70000, database=Database)
+        node.available = True
+        monitor = NodeMonitor(node)
+
+        checked = []
+        monitor.start(lambda: checked.append(True))
+
+        try:
+            self.assertEquals(checked, [True])
+            self.assertFalse(monitor._checking)
+            self.assertIsNotNone(monitor._next_check)
+            self.assertFalse(node.available)
+        finally:
+            monitor.stop()
@@ -1,13 +1,15 @@
 # coding: utf-8
 import six
+import time
 from tornado.ioloop import IOLoop
 from tornado import testing
 from bson import ObjectId
 from mongotor.connection import Connection
 from mongotor.pool import ConnectionPool
 from mongotor.database import Database
-from mongotor.errors import TooManyConnections
+from mongotor.errors import TooManyConnections, InterfaceError
 from mongotor import message
+from functools import partial
 
 
 class ConnectionPoolTestCase(testing.AsyncTestCase):
@@ -23,6 +25,14 @@ class ConnectionPoolTestCase(testing.AsyncTestCase):
 
         self.assertIsInstance(conn, Connection)
 
+    def test_raise_interface_error_when_node_is_down(self):
+        """[ConnectionPoolTestCase] - Raise InterfaceError when connection can't be established"""
+        pool = ConnectionPool('localhost', 27000, dbname='test')
+        pool.connection(self.stop)
+
+        self.assertRaises(InterfaceError, self.wait)
+        self.assertEquals(pool._connections, 0)
+
     def test_wait_for_connection_when_maxconnection_is_reached(self):
         """[ConnectionPoolTestCase] - Wait for a connection when maxconnections is reached"""
 
@@ -53,6 +63,47 @@ class ConnectionPoolTestCase(testing.AsyncTestCase):
         pool.connection(self.stop)
         self.assertRaises(TooManyConnections, self.wait)
 
+    def test_waiters_receive_released_connections_in_order(self):
+        """[ConnectionPoolTestCase] - Hand released connections to waiters in FIFO order"""
+
+        pool = ConnectionPool('localhost', 27027, dbname='test', maxconnections=1)
+
+        pool.connection(self.stop)
+        conn = self.wait()
+
+        served = []
+
+        def waiter(name, connection):
+            served.append((name, connection))
+            if len(served) == 2:
+                self.stop()
+            else:
+                pool.release(connection)
+
+        pool.connection(partial(waiter, 'first'))
+        pool.connection(partial(waiter, 'second'))
+        self.assertEquals(len(pool._waiters), 2)
+
+        pool.release(conn)
+        self.wait()
+
+        self.assertEquals([name for name, _ in served], ['first', 'second'])
+        self.assertEquals(served[1][1], conn)
+        self.assertEquals(len(pool._waiters), 0)
+        self.assertEquals(pool._connections, 1)
+
+    def test_raise_too_many_connection_when_max_waiters_is_reached(self):
+        """[ConnectionPoolTestCase] - Raise TooManyConnections when max_waiters is reached"""
+
+        pool = ConnectionPool('localhost', 27027, dbname='test', maxconnections=1,
+                              max_waiters=1)
+
+        pool.connection(self.stop)
+        self.wait()
+
+        pool.connection(self.stop)
+        self.assertRaises(TooManyConnections, pool.connection, self.stop)
+
     def test_close_connection_stream_should_be_release_from_pool(self):
         """[ConnectionPoolTestCase] - Release connection from pool when stream is closed"""
 
@@ -144,6 +195,121 @@ class ConnectionPoolTestCase(testing.AsyncTestCase):
         self.assertEquals(len(pool._idle_connections), 0)
         self.assertEquals(pool._connections, 0)
 
+    def test_multiplexed_pool_shares_connections(self):
+        """[ConnectionPoolTestCase] - Multiplexed pool shares connections between requests"""
+        pool = ConnectionPool('localhost', 27027, dbname='test', multiplex=True)
+
+        message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+            {'driverOIDTest': ObjectId()})
+
+        pool.connection(self.stop)
+        conn1 = self.wait()
+        conn1.send_message_with_response(message_test, callback=lambda r: None)
+
+        pool.connection(self.stop)
+        conn2 = self.wait()
+
+        self.assertEquals(conn1, conn2)
+        self.assertEquals(pool._connections, 0)
+        self.assertEquals(len(pool._shared_connections), 1)
+
+    def test_multiplexed_pool_opens_connection_when_max_in_flight_is_reached(self):
+        """[ConnectionPoolTestCase] - Multiplexed pool opens a connection when max_in_flight is reached"""
+        pool = ConnectionPool('localhost', 27027, dbname='test', multiplex=True,
+                              max_in_flight=1)
+
+        message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+            {'driverOIDTest': ObjectId()})
+
+        pool.connection(self.stop)
+        conn1 = self.wait()
+        conn1.send_message_with_response(message_test, callback=self.stop)
+
+        pool.connection(self.stop)
+        conn2 = self.wait()
+        self.wait()
+
+        self.assertNotEqual(conn1, conn2)
+        self.assertEquals(len(pool._shared_connections), 2)
+
+    def test_reuse_most_recently_released_connection(self):
+        """[ConnectionPoolTestCase] - Reuse the most recently released connection first"""
+        pool = ConnectionPool('localhost', 27027, dbname='test')
+
+        pool.connection(self.stop)
+        conn1 = self.wait()
+        pool.connection(self.stop)
+        conn2 = self.wait()
+
+        pool.release(conn1)
+        pool.release(conn2)
+        pool.release(conn2)
+
+        self.assertEquals(len(pool._idle_connections), 2)
+        self.assertEquals(pool._connections, 0)
+
+        pool.connection(self.stop)
+        self.assertEquals(self.wait(), conn2)
+
+    def test_no_maintenance_by_default(self):
+        """[ConnectionPoolTestCase] - Don't schedule maintenance when none of its settings is given"""
+        pool = ConnectionPool('localhost', 27027, dbname='test', maxconnections=10)
+
+        self.assertIsNone(pool._maintenance)
+        pool.close()
+
+    def test_maintenance_closes_idle_connections_above_min_idle(self):
+        """[ConnectionPoolTestCase] - Close connections idle for too long, keeping min_idle"""
+        pool = ConnectionPool('localhost', 27027, dbname='test', maxconnections=10,
+                              min_idle=2, max_idle_time=0.1, maintenance_interval=0.05)
+
+        connections = []
+        for i in six.moves.range(5):
+            pool.connection(self.stop)
+            connections.append(self.wait())
+        for conn in connections:
+            pool.release(conn)
+
+        self.assertEquals(len(pool._idle_connections), 5)
+
+        IOLoop.instance().add_timeout(time.time() + 0.3, self.stop)
+        self.wait()
+
+        self.assertEquals(len(pool._idle_connections), 2)
+        self.assertEquals(len([conn for conn in connections if conn.closed()]), 3)
+        pool.close()
+
+    def test_maintenance_closes_idle_connections_without_min_idle(self):
+        """[ConnectionPoolTestCase] - Close every connection idle for too long when only max_idle_time is given"""
+        pool = ConnectionPool('localhost', 27027, dbname='test', maxconnections=10,
+                              max_idle_time=0.1, maintenance_interval=0.05)
+        self.assertEquals(len(pool._idle_connections), 0)
+
+        pool.connection(self.stop)
+        conn = self.wait()
+        pool.release(conn)
+
+        IOLoop.instance().add_timeout(time.time() + 0.3, self.stop)
+        self.wait()
+
+        self.assertTrue(conn.closed())
+        self.assertEquals(len(pool._idle_connections), 0)
+        pool.close()
+
+    def test_maintenance_replaces_connections_past_max_lifetime(self):
+        """[ConnectionPoolTestCase] - Replace connections open for longer than max_lifetime"""
+        pool = ConnectionPool('localhost', 27027, dbname='test', min_idle=1,
+                              max_lifetime=0.1, maintenance_interval=0.05)
+        conn = pool._idle_connections[0]
+
+        IOLoop.instance().add_timeout(time.time() + 0.3, self.stop)
+        self.wait()
+
+        self.assertTrue(conn.closed())
+        self.assertEquals(len(pool._idle_connections), 1)
+        self.assertNotEqual(pool._idle_connections[0], conn)
+        pool.close()
+
     def test_check_connections_when_use_cursors(self):
         """[ConnectionPoolTestCase] - check connections when use cursors"""
         db = Database.init('localhost:27027', dbname='test', maxconnections=10, maxusage=29)
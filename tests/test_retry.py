@@ -0,0 +1,50 @@
+# coding: utf-8
+import time
+from mongotor.retry import RetryPolicy
+from mongotor.errors import (InterfaceError, TooManyConnections,
+    NotMasterError, DatabaseError)
+from tests.util import unittest
+
+
+class RetryPolicyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = RetryPolicy(retries=1, backoff=0.1, max_backoff=0.15, deadline=5)
+
+    def test_retry_lost_connection(self):
+        """[RetryPolicyTestCase] - retry an idempotent operation after a lost connection"""
+        self.assertTrue(self.policy.should_retry(InterfaceError('connection closed'),
+                                                 0, time.time()))
+
+    def test_not_retry_lost_connection_when_not_idempotent(self):
+        """[RetryPolicyTestCase] - not retry a non idempotent operation after a lost connection"""
+        self.assertFalse(self.policy.should_retry(InterfaceError('connection closed'),
+                                                  0, time.time(), idempotent=False))
+
+    def test_retry_not_master_when_not_idempotent(self):
+        """[RetryPolicyTestCase] - retry any operation rejected by a node that is not master"""
+        self.assertTrue(self.policy.should_retry(NotMasterError('not master'),
+                                                 0, time.time(), idempotent=False))
+
+    def test_not_retry_other_errors(self):
+        """[RetryPolicyTestCase] - not retry busy pools and database errors"""
+        self.assertFalse(self.policy.should_retry(TooManyConnections('busy'),
+                                                  0, time.time()))
+        self.assertFalse(self.policy.should_retry(DatabaseError('error'),
+                                                  0, time.time()))
+
+    def test_not_retry_more_than_retries(self):
+        """[RetryPolicyTestCase] - not retry more than the allowed retries"""
+        self.assertFalse(self.policy.should_retry(InterfaceError('connection closed'),
+                                                  1, time.time()))
+
+    def test_not_retry_past_deadline(self):
+        """[RetryPolicyTestCase] - not retry once the deadline passed"""
+        self.assertFalse(self.policy.should_retry(InterfaceError('connection closed'),
+                                                  0, time.time() - 5))
+
+    def test_jittered_backoff(self):
+        """[RetryPolicyTestCase] - backoff is jittered and capped"""
+        for attempt in (1, 2, 3):
+            delay = self.policy.delay(attempt)
+            self.assertTrue(0 <= delay <= 0.15)
@@ -1,6 +1,7 @@
 ## copied from tornado source code:
 
 import sys
+from mongotor import events
 
 # Encapsulate the choice of unittest or unittest2 here.
 # To be used as 'from tests.util import unittest'.
@@ -8,3 +9,23 @@ if sys.version_info >= (2, 7):
     import unittest
 else:
     import unittest2 as unittest
+
+
+class Listener(events.CommandListener):
+    """Records the command events published, as ``(name, event)``"""
+
+    def __init__(self):
+        self.events = []
+
+    def started(self, event):
+        self.events.append(('started', event))
+
+    def succeeded(self, event):
+        self.events.append(('succeeded', event))
+
+    def failed(self, event):
+        self.events.append(('failed', event))
+
+    def of(self, operation):
+        return [(name, event) for name, event in self.events
+                if event.operation == operation]